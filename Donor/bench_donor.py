@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+benchmarks for loading donations into a DonorCollection
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import tempfile
+import time
+
+from donor import DonorCollection
+from donor import SqliteDonorCollection
+from donor import iter_donation_rows
+
+
+def write_files(directory, count, donors=100000, seed=0):
+    """a CSV and a JSON lines file with the same count random rows"""
+    rng = random.Random(seed)
+    csv_path = os.path.join(directory, "donations.csv")
+    jsonl_path = os.path.join(directory, "donations.jsonl")
+    with open(csv_path, "w") as csv_file, open(jsonl_path, "w") as jsonl_file:
+        csv_file.write("name,amount\n")
+        for _ in range(count):
+            name = "donor{}".format(rng.randrange(donors))
+            amount = rng.randrange(1, 10000)
+            csv_file.write("{},{}\n".format(name, amount))
+            jsonl_file.write(json.dumps({"name": name, "amount": amount}) + "\n")
+    return csv_path, jsonl_path
+
+
+def timed(label, count, func, *args):
+    """run func once and print the rows per second"""
+    begin = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - begin
+    print("{:<40} {:>8.2f} s {:>12,.0f} rows/s".format(label, elapsed,
+                                                      count / elapsed))
+    return elapsed
+
+
+def load_per_call(path):
+    """the old way: one add_new_donor/add_donation call per row"""
+    d_c = DonorCollection()
+    seen = set()
+    for name, amount in iter_donation_rows(path):
+        if name not in seen:
+            seen.add(name)
+            d_c.add_new_donor(name)
+        d_c.add_donation(name, amount)
+
+
+def progress_printer(count):
+    """a progress callback printing every tenth of count"""
+    step = max(count // 10, 1)
+    state = {"next": step}
+
+    def progress(loaded):
+        if loaded >= state["next"]:
+            print("  {:,} rows".format(loaded), end="\r")
+            state["next"] = loaded + step
+    return progress
+
+
+def bench_load(args, directory):
+    """rows/s per file format and collection"""
+    count = args.rows
+    csv_path, jsonl_path = write_files(directory, count, args.donors)
+    for label, path in (("csv", csv_path), ("jsonl", jsonl_path)):
+        timed("{}: per call".format(label), count, load_per_call, path)
+        timed("{}: bulk_load".format(label), count,
+              DonorCollection().bulk_load, path, progress_printer(count))
+        db_path = os.path.join(directory, "{}.db".format(label))
+        with SqliteDonorCollection(db_path) as d_c:
+            timed("{}: bulk_load into SQLite".format(label), count,
+                  d_c.bulk_load, path, progress_printer(count))
+
+
+def write_to_file_in(directory, d_c):
+    """the old write_to_file, run inside directory with stdout discarded"""
+    cwd = os.getcwd()
+    os.makedirs(directory)
+    os.chdir(directory)
+    try:
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            d_c.write_to_file()
+    finally:
+        os.chdir(cwd)
+
+
+def bench_letters(args, directory):
+    """letters/s for write_to_file and write_letters, one letter per donor"""
+    count = args.rows
+    d_c = DonorCollection()
+    rng = random.Random(0)
+    d_c.bulk_load(("donor{}".format(i), rng.randrange(1, 10000))
+                  for i in range(count))
+    timed("letters: write_to_file", count, write_to_file_in,
+          os.path.join(directory, "old"), d_c)
+    timed("letters: write_letters", count, d_c.write_letters,
+          os.path.join(directory, "new"))
+    for archive in ("zip", "tar"):
+        timed("letters: write_letters {}".format(archive), count,
+              d_c.write_letters, os.path.join(directory, archive), archive)
+
+
+BENCHMARKS = {
+    "load": bench_load,
+    "letters": bench_letters,
+}
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="donor benchmarks")
+    PARSER.add_argument("-n", "--rows", type=int, default=10000000,
+                        help="number of donation rows. Defaults to 10M")
+    PARSER.add_argument("-d", "--donors", type=int, default=100000,
+                        help="number of distinct donors in the load "
+                        "benchmark. Defaults to 100k")
+    PARSER.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run, from {}. Defaults to all"
+                        .format(", ".join(BENCHMARKS)))
+    ARGS = PARSER.parse_args()
+    for NAME in ARGS.benchmarks:
+        if NAME not in BENCHMARKS:
+            PARSER.error("unknown benchmark {!r}".format(NAME))
+
+    print("{:,} rows".format(ARGS.rows))
+    with tempfile.TemporaryDirectory() as DIRECTORY:
+        for NAME in ARGS.benchmarks or BENCHMARKS:
+            BENCHMARKS[NAME](ARGS, DIRECTORY)
@@ -1,13 +1,160 @@
 #!/usr/bin/env python3
 """Donor module to keep records of donations"""
 
+import csv
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tarfile
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from functools import reduce
+from itertools import groupby, islice
+from operator import add, itemgetter
+from urllib.parse import quote
+
+REPORT_HEADER = "|{:>12}|{:>12}|{:>12}|{:>12}|".format("Name", "Total", "Average", "# donations")
+REPORT_ROW = "|{:>12}|{:>12}|{:>12}|{}|"
+
+
+def parse_amount(text):
+    """a donation amount from text, an int if it is a whole number"""
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _check_amount(donation):
+    """raise if donation can't be stored in SQLite as it is"""
+    if not isinstance(donation, (int, float)):
+        raise TypeError("donation must be int or float, not {}".format(
+            type(donation).__name__))
+    if isinstance(donation, int) and not -2**63 <= donation < 2**63:
+        raise ValueError("donation {} does not fit in 64 bits".format(donation))
+    if donation != donation:
+        #NaN would be stored as NULL
+        raise ValueError("donation must not be NaN")
+
+
+def letter_path(name):
+    """relative path of a donor's letter, in one of 256 shard directories
+
+    The file name is the percent-encoded donor name. Names of only dots
+    have their dots encoded too, and the empty name becomes "%", which
+    quote() never produces. Names that would encode to more than 255
+    bytes are cut short and end in "%-" and the MD5 of the whole name,
+    also never produced by quote(). No two names share a file, except on
+    a case-insensitive filesystem, where names differing only in case
+    can when they fall in the same shard.
+    """
+    digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+    file_name = quote(name, safe="")
+    if not file_name.strip("."):
+        #"", "." and ".." are not usable file names
+        file_name = file_name.replace(".", "%2E") or "%"
+    elif len(file_name) > 255:
+        #most filesystems allow 255 bytes, quote() gives ASCII; don't
+        #leave half of a %XX escape at the cut
+        file_name = file_name[:200]
+        cut = file_name.rfind("%", -2)
+        if cut != -1:
+            file_name = file_name[:cut]
+        file_name += "%-" + digest
+    return "{}/{}".format(digest[:2], file_name)
+
+
+def _write_letters(directory, letters):
+    """thread pool task: write a batch of (path, text) letters"""
+    for path, text in letters:
+        with open(os.path.join(directory, path), "wb") as f:
+            f.write(text.encode("utf-8"))
+
+
+def _write_archive(directory, archive, letters):
+    """pack (path, text) letters into directory/letters.<archive>"""
+    if archive not in ("zip", "tar", "tar.gz"):
+        raise ValueError("unknown archive type {!r}".format(archive))
+    path = os.path.join(directory, "letters." + archive)
+    count = 0
+    if archive == "zip":
+        with zipfile.ZipFile(path, "w") as f:
+            for name, text in letters:
+                f.writestr(name, text)
+                count += 1
+        return count
+    now = time.time()
+    with tarfile.open(path, "w:gz" if archive == "tar.gz" else "w") as f:
+        for name, text in letters:
+            data = text.encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = now
+            f.addfile(info, io.BytesIO(data))
+            count += 1
+    return count
+
+
+def iter_donation_rows(source, parse=parse_amount):
+    """(name, amount) pairs from a file path or an iterable
+
+    A path ending in .csv is read as CSV with name and amount columns,
+    amounts converted by parse, or left as text if it is None; any other
+    path as JSON lines of {"name": ..., "amount": ...}. An iterable may
+    give (name, amount) pairs or dicts with those keys. Files are read
+    as they are consumed.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, newline="") as f:
+            if os.fspath(source).lower().endswith(".csv"):
+                rows = csv.reader(f)
+                header = next(rows, [])
+                if "name" not in header or "amount" not in header:
+                    raise ValueError(
+                        "{} needs a header row with name and amount columns, "
+                        "found {}".format(os.fspath(source), header))
+                columns = itemgetter(header.index("name"),
+                                     header.index("amount"))
+                if parse is None:
+                    yield from map(columns, rows)
+                    return
+                for name, amount in map(columns, rows):
+                    yield name, parse(amount)
+            else:
+                for line in f:
+                    if line.strip():
+                        row = json.loads(line)
+                        yield row["name"], row["amount"]
+        return
+    for row in source:
+        if isinstance(row, dict):
+            yield row["name"], row["amount"]
+        else:
+            yield row[0], row[1]
+
 class Donor:
-    """for individula donor"""
+    """for individula donor
+
+    Whole-number donations are stored as 64 bit integers in an array,
+    8 bytes each; the first donation of any other kind (float, Decimal,
+    or too large) moves them to a plain list.
+    """
+    __slots__ = ("__name", "__donations", "__total", "__min", "__max")
+
     def __init__(self, name, initial_donation=None):
         self.__name = name
-        self.__donations = []
+        self.__donations = array("q")
+        #running aggregates, kept up to date by add_donation
+        self.__total = 0
+        self.__min = None
+        self.__max = None
         if initial_donation is not None:
-            self.__donations.append(initial_donation)
+            self.add_donation(initial_donation)
 
     @property
     def name(self):
@@ -16,8 +163,17 @@ class Donor:
 
     @property
     def donation(self):
-        """get donation amount"""
-        return self.__donations
+        """get donation amounts, as a read-only sequence
+
+        A memoryview over the int64 array, without copying, while every
+        donation is a whole number that fits; a tuple once they are kept
+        in a list. Both support len(), indexing, iteration and sum(), but
+        compare a memoryview with == only against another buffer: use
+        list(d.donation) to compare against a list or tuple.
+        """
+        if isinstance(self.__donations, array):
+            return memoryview(self.__donations).toreadonly()
+        return tuple(self.__donations)
 
     @property
     def num_donations(self):
@@ -26,33 +182,108 @@ class Donor:
 
     @property
     def total_donations(self):
-        """get total donations"""
-        return sum(self.__donations)
+        """get total donations, Decimal amounts give a Decimal total"""
+        return self.__total
 
     @property
     def avg_donation(self):
         """average donation amount"""
-        return self.total_donations/self.num_donations
+        return self.__total/len(self.__donations)
+
+    @property
+    def min_donation(self):
+        """smallest donation, None before the first one"""
+        return self.__min
+
+    @property
+    def max_donation(self):
+        """largest donation, None before the first one"""
+        return self.__max
 
-    #you can call instance.__dict__ to view this information
     def __str__(self):
-        return "[Donor name = {}, donations = {}]".format(self.__name, self.__donations)
+        return "[Donor name = {}, donations = {}]".format(self.__name,
+                                                          list(self.__donations))
 
     #__is not directly viewed from outside, make attribute invisible from outside
     def add_donation(self, donation):
-        """add donation to donor"""
-        self.__donations.append(donation)
+        """add donation to donor and update the running aggregates"""
+        #same order of additions as sum(), so float totals do not change;
+        #computed first so an amount that can't be added changes nothing
+        total = self.__total + donation
+        low = donation if self.__min is None or donation < self.__min \
+            else self.__min
+        high = donation if self.__max is None or donation > self.__max \
+            else self.__max
+        try:
+            self.__donations.append(donation)
+        except (TypeError, OverflowError):
+            #not an int64, keep everything in a list from now on
+            self.__donations = list(self.__donations)
+            self.__donations.append(donation)
+        except BufferError:
+            #a memoryview from donation is still alive, so the array can't
+            #grow in place; the view keeps the old copy
+            self.__donations = array("q", self.__donations)
+            self.__donations.append(donation)
+        self.__total, self.__min, self.__max = total, low, high
+
+    def add_donations(self, donations):
+        """add a list of donations, same as add_donation for each in turn
+
+        The aggregates are computed over the whole list in C, and the
+        array is extended in one call.
+        """
+        if donations:
+            self._extend(donations, self._aggregates(donations))
+
+    def _aggregates(self, donations):
+        """total, min and max after adding a non-empty list of donations
+
+        Raises, changing nothing, if they can't be added.
+        """
+        #reduce adds in the same order as add_donation, sum() may not
+        total = reduce(add, donations, self.__total)
+        low = min(donations)
+        high = max(donations)
+        if self.__min is not None:
+            low = min(self.__min, low)
+            high = max(self.__max, high)
+        return total, low, high
+
+    def _extend(self, donations, aggregates):
+        """store donations with the aggregates _aggregates gave for them"""
+        if isinstance(self.__donations, array):
+            length = len(self.__donations)
+            try:
+                try:
+                    self.__donations.extend(donations)
+                except BufferError:
+                    #see add_donation
+                    self.__donations = array("q", self.__donations)
+                    self.__donations.extend(donations)
+            except (TypeError, OverflowError):
+                #extend stops at the first amount that isn't an int64
+                del self.__donations[length:]
+                self.__donations = list(self.__donations)
+                self.__donations.extend(donations)
+        else:
+            self.__donations.extend(donations)
+        self.__total, self.__min, self.__max = aggregates
 
     #generate report row
     def generate_report_row(self):
         """a report of donations"""
-        return "|{:>12}|{:>12}|{:>12}|{}|".format(self.__name, self.total_donations,\
-         self.avg_donation, self.__donations)
+        return REPORT_ROW.format(self.__name, self.total_donations,\
+         self.avg_donation, list(self.__donations))
+
+    def letter(self):
+        """the thank you letter text, without printing it"""
+        return "Dear {},\n Thank you for your donation of {}!\n".format(self.__name, \
+        list(self.__donations))
 
     def thank_you(self):
         """print a thank you letter to the donor"""
-        message = "Dear {},\n Thank you for your donation of {}!\n".format(self.__name, \
-        self.__donations)
+        message = self.letter()
         print(message)
         return message
 
@@ -61,6 +292,9 @@ class DonorCollection:
     """this class is to record different donors"""
     def __init__(self):
         self.__donors = {} #name: Donor pairs
+        self.__pending = defaultdict(list) #name: [amounts] read by bulk_load
+        self.__pending_chunks = [] #the same rows, in the order read
+        self.__pending_rows = 0
 
     def add_new_donor(self, name):
         """add a new donor to the collection"""
@@ -76,25 +310,347 @@ class DonorCollection:
         """get donor history of a specific donor"""
         return self.__donors[name]
 
+    def donors(self):
+        """iterate over the donors in the order they were added"""
+        return iter(self.__donors.values())
+
+    def bulk_load(self, source, progress=None, chunk_size=100000):
+        """add donations from a file or an iterable, see iter_donation_rows
+
+        Donors that don't exist yet are created. Rows are read chunk_size
+        at a time, and progress(rows read so far) is called after each
+        chunk. The rows are grouped by donor and each donor's amounts are
+        added with one add_donations call; CSV amounts are parsed then,
+        a list at a time. If a row can't be read or added, the rows before
+        it are added and the error is raised. Returns the number of rows
+        loaded.
+        """
+        rows = iter_donation_rows(source, parse=self._csv_parse)
+        loaded = 0
+        try:
+            while True:
+                chunk = []
+                try:
+                    chunk.extend(islice(rows, chunk_size))
+                except Exception:
+                    #extend() kept the rows read before the error
+                    self._add_chunk(chunk)
+                    raise
+                if not chunk:
+                    return loaded
+                self._add_chunk(chunk)
+                loaded += len(chunk)
+                if progress is not None:
+                    progress(loaded)
+        finally:
+            self._add_pending()
+
+    #CSV amounts stay text until _add_pending converts them per donor
+    _csv_parse = None
+
+    def _add_chunk(self, chunk):
+        """group a list of (name, amount) rows by donor
+
+        The groups are added with one add_donations call per donor, once
+        they average 16 rows each or at the end of bulk_load, so the
+        per-donor cost is shared by many rows while the pending amounts
+        stay bounded by the number of donors.
+        """
+        pending = self.__pending
+        for name, amount in chunk:
+            pending[name].append(amount)
+        self.__pending_chunks.append(chunk)
+        self.__pending_rows += len(chunk)
+        if self.__pending_rows >= 16 * len(pending):
+            self._add_pending()
+
+    def _add_pending(self):
+        """add the donations grouped by _add_chunk
+
+        Every group is converted and checked before any is added. If one
+        fails, the rows are added one at a time in the order they were
+        read instead, up to the one that fails.
+        """
+        pending, chunks = self.__pending, self.__pending_chunks
+        self.__pending = defaultdict(list)
+        self.__pending_chunks = []
+        self.__pending_rows = 0
+        donors = self.__donors
+        groups = []
+        try:
+            for name, amounts in pending.items():
+                if type(amounts[0]) is str:
+                    try:
+                        amounts = list(map(int, amounts))
+                    except ValueError:
+                        amounts = list(map(parse_amount, amounts))
+                donor = donors.get(name)
+                if donor is None:
+                    donor = Donor(name)
+                groups.append((donor, amounts, donor._aggregates(amounts)))
+        except Exception:
+            for chunk in chunks:
+                for name, amount in chunk:
+                    if type(amount) is str:
+                        amount = parse_amount(amount)
+                    donor = donors.get(name)
+                    if donor is None:
+                        donor = Donor(name)
+                    donor.add_donation(amount)
+                    donors.setdefault(name, donor)
+            return
+        for donor, amounts, aggregates in groups:
+            donor._extend(amounts, aggregates)
+            donors.setdefault(donor.name, donor)
+
     def generate_report(self):
         """generate a report of all donors"""
-        header = "|{:>12}|{:>12}|{:>12}|{:>12}|".format("Name", "Total", "Average", "# donations")
-        lines = [header]
-        #values(), donor object, an instance of donor class
-        for donor in self.__donors.values():
+        lines = [REPORT_HEADER]
+        #donor object, an instance of donor class
+        for donor in self.donors():
             lines.append(donor.generate_report_row())
         return "\n".join(lines)
 
     def thank_you_letter(self):
         """send a thank you letter to each donor"""
-        for donor in self.__donors.values():
+        for donor in self.donors():
             donor.thank_you()
 
     def write_to_file(self):
         """write letters into txt files"""
-        for name in self.__donors.keys():
-            with open(name, "w") as f:
-                f.write(self.__donors[name].thank_you())
+        for donor in self.donors():
+            with open(donor.name, "w") as f:
+                f.write(donor.thank_you())
+
+    def write_letters(self, directory, archive=None, workers=None,
+                      batch_size=1000):
+        """write every donor's letter without printing, see letter_path
+
+        Letters go to directory/<shard>/<donor name>, written in batches
+        of batch_size by a pool of workers threads. With archive set to
+        "zip", "tar" or "tar.gz" they are instead packed into one
+        directory/letters.<archive> file, with the same member names; zip
+        members are stored uncompressed, which is faster for tiny files.
+        Returns the number of letters.
+        """
+        os.makedirs(directory, exist_ok=True)
+        letters = ((letter_path(donor.name), donor.letter())
+                   for donor in self.donors())
+        if archive is not None:
+            return _write_archive(directory, archive, letters)
+
+        for shard in range(256):
+            os.makedirs(os.path.join(directory, "{:02x}".format(shard)),
+                        exist_ok=True)
+        #the ThreadPoolExecutor default
+        workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        count = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            while True:
+                batch = list(islice(letters, batch_size))
+                if not batch:
+                    break
+                count += len(batch)
+                pending.append(executor.submit(_write_letters, directory, batch))
+                #keep only a few batches in memory at a time
+                if len(pending) >= 2 * workers:
+                    pending.pop(0).result()
+            for future in pending:
+                future.result()
+        return count
+
+
+class SqliteDonorCollection(DonorCollection):
+    """a DonorCollection kept in an SQLite database file
+
+    Donations go to an append-only table, indexed by donor, and are
+    written in batches of batch_size per transaction; the database runs
+    in WAL mode, so a commit only appends to the write-ahead log. Opening
+    reads nothing up front. Amounts must be int or float, ints must fit
+    in 64 bits, and NaN is not allowed. get_donor returns a snapshot Donor;
+    changes to it are not saved. Call close(), or use a with block, to
+    write the last batch.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS donors (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS donations (
+            id INTEGER PRIMARY KEY,
+            donor_id INTEGER NOT NULL REFERENCES donors (id),
+            amount NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS donations_donor ON donations (donor_id, id);
+    """
+    #amounts are inserted as they are read
+    _csv_parse = staticmethod(parse_amount)
+
+    def __init__(self, path, batch_size=10000):
+        super().__init__()
+        self.__conn = sqlite3.connect(path)
+        self.__conn.execute("PRAGMA journal_mode = WAL")
+        self.__conn.execute("PRAGMA synchronous = NORMAL")
+        self.__conn.execute("PRAGMA foreign_keys = ON")
+        self.__conn.executescript(self.SCHEMA)
+        self.__batch_size = batch_size
+        self.__pending = [] #(donor_id, amount) rows not yet inserted
+        self.__ids = {} #name: donor id, filled on first use
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __donor_id(self, name):
+        """the id of donor name, KeyError if there is none"""
+        try:
+            return self.__ids[name]
+        except KeyError:
+            row = self.__conn.execute("SELECT id FROM donors WHERE name = ?",
+                                      (name,)).fetchone()
+            if row is None:
+                raise
+            self.__ids[name] = row[0]
+            return row[0]
+
+    def __fetch_ids(self, names):
+        """look up the ids of the donors in names that exist"""
+        #SQLite allows 999 parameters per statement in older versions
+        for start in range(0, len(names), 900):
+            batch = names[start:start + 900]
+            self.__ids.update(self.__conn.execute(
+                "SELECT name, id FROM donors WHERE name IN ({})".format(
+                    ", ".join("?" * len(batch))), batch))
+
+    def add_new_donor(self, name):
+        """add a new donor to the collection"""
+        try:
+            with self.__conn:
+                cursor = self.__conn.execute(
+                    "INSERT INTO donors (name) VALUES (?)", (name,))
+        except sqlite3.IntegrityError:
+            raise ValueError("name({}) already exists".format(name)) from None
+        self.__ids[name] = cursor.lastrowid
+
+    def add_donation(self, name, donation):
+        """add new donation, inserted with the next batch"""
+        #checked now, a bad amount would only fail at the next flush
+        _check_amount(donation)
+        self.__pending.append((self.__donor_id(name), donation))
+        if len(self.__pending) >= self.__batch_size:
+            self.flush()
+
+    def flush(self):
+        """insert the pending donations and commit, in one transaction
+
+        The batch is dropped if it can't be inserted, so one failure does
+        not make every later call fail too.
+        """
+        pending = self.__pending
+        self.__pending = []
+        with self.__conn:
+            self.__conn.executemany(
+                "INSERT INTO donations (donor_id, amount) VALUES (?, ?)",
+                pending)
+
+    def _add_chunk(self, chunk):
+        """insert a list of (name, amount) rows, and their new donors, in
+        one transaction
+
+        An amount add_donation would reject is raised after the rows
+        before it are inserted.
+        """
+        error = None
+        for index, (_, amount) in enumerate(chunk):
+            try:
+                _check_amount(amount)
+            except (TypeError, ValueError) as e:
+                chunk, error = chunk[:index], e
+                break
+        self.flush()
+        ids = self.__ids
+        missing = [name for name in dict.fromkeys(name for name, _ in chunk)
+                   if name not in ids]
+        new = []
+        try:
+            with self.__conn:
+                if missing:
+                    self.__fetch_ids(missing)
+                    new = [(name,) for name in missing if name not in ids]
+                    self.__conn.executemany(
+                        "INSERT INTO donors (name) VALUES (?)", new)
+                    self.__fetch_ids([name for (name,) in new])
+                self.__conn.executemany(
+                    "INSERT INTO donations (donor_id, amount) VALUES (?, ?)",
+                    [(ids[name], amount) for name, amount in chunk])
+        except BaseException:
+            #the new donors were rolled back, so are their cached ids
+            for (name,) in new:
+                ids.pop(name, None)
+            raise
+        if error is not None:
+            raise error
+
+    def close(self):
+        """flush and close the database"""
+        try:
+            self.flush()
+        finally:
+            self.__conn.close()
+
+    def get_donor(self, name):
+        """get donor history of a specific donor"""
+        donor_id = self.__donor_id(name)
+        self.flush()
+        donor = Donor(name)
+        for (amount,) in self.__conn.execute(
+                "SELECT amount FROM donations WHERE donor_id = ? ORDER BY id",
+                (donor_id,)):
+            donor.add_donation(amount)
+        return donor
+
+    def __amounts(self):
+        """(donor id, [amounts]) per donor with donations, by donor id"""
+        rows = self.__conn.execute(
+            "SELECT donor_id, amount FROM donations ORDER BY donor_id, id")
+        for donor_id, group in groupby(rows, key=lambda row: row[0]):
+            yield donor_id, [amount for _, amount in group]
+
+    def donors(self):
+        """iterate over the donors in the order they were added"""
+        self.flush()
+        amounts = self.__amounts()
+        current = next(amounts, (None, []))
+        for donor_id, name in self.__conn.execute(
+                "SELECT id, name FROM donors ORDER BY id"):
+            donor = Donor(name)
+            if current[0] == donor_id:
+                for amount in current[1]:
+                    donor.add_donation(amount)
+                current = next(amounts, (None, []))
+            yield donor
+
+    def generate_report(self):
+        """generate a report of all donors, without building Donors"""
+        self.flush()
+        lines = [REPORT_HEADER]
+        amounts = self.__amounts()
+        current = next(amounts, (None, []))
+        for donor_id, name in self.__conn.execute(
+                "SELECT id, name FROM donors ORDER BY id"):
+            donations = []
+            if current[0] == donor_id:
+                donations = current[1]
+                current = next(amounts, (None, []))
+            #added in the order Donor.add_donation adds them; SQL SUM()
+            #may round float totals differently
+            total = reduce(add, donations, 0)
+            lines.append(REPORT_ROW.format(name, total, total/len(donations),
+                                           donations))
+        return "\n".join(lines)
 
 if __name__ == "__main__":
     D_C = DonorCollection()
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
+import sys
+
 from donor import *
 
 if __name__ == "__main__":
-    dc = DonorCollection()
-    while True:
-        user_input = int(input("\
+    #donors are kept in a database file, by default donors.db; with a
+    #batch of 1 every donation is committed as soon as it is entered
+    dc = SqliteDonorCollection(sys.argv[1] if len(sys.argv) > 1 else "donors.db",
+                               batch_size=1)
+    try:
+        while True:
+            user_input = int(input("\
         1. add new donor\n\
         2. add donation to existing donor\n\
         3. full report\n\
@@ -13,23 +19,25 @@ if __name__ == "__main__":
         5. write letter into txt file\n\
         6. quit"))
 
-        if user_input == 1:
-            input_name = input("What's the name of new donor?")
-            dc.add_new_donor(input_name)
+            if user_input == 1:
+                input_name = input("What's the name of new donor?")
+                dc.add_new_donor(input_name)
             
-        if user_input == 4:
-            print(dc.thank_you_letter())
+            if user_input == 4:
+                print(dc.thank_you_letter())
             
-        if user_input == 2:
-            input_name2 = input("what's the name?")
-            input_donation = int(input("how much would you like to donate?"))
-            dc.add_donation(input_name2, input_donation)
+            if user_input == 2:
+                input_name2 = input("what's the name?")
+                input_donation = int(input("how much would you like to donate?"))
+                dc.add_donation(input_name2, input_donation)
             
-        if user_input == 3:
-            print(dc.generate_report())
+            if user_input == 3:
+                print(dc.generate_report())
             
-        if user_input == 5:
-            dc.write_to_file()
+            if user_input == 5:
+                dc.write_to_file()
 
-        if user_input == 6:
-            break
+            if user_input == 6:
+                break
+    finally:
+        dc.close()
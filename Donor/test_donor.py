@@ -2,15 +2,23 @@
 
 """pytest for donor"""
 
+import json
+import os
+import sqlite3
+import tarfile
+import zipfile
+from decimal import Decimal
 from donor import Donor
 from donor import DonorCollection
+from donor import SqliteDonorCollection
+from donor import letter_path
 import pytest
 
 def test_donor_class():
     """test donor"""
     d = Donor("Bill Gates", 1000)
     assert d.name == "Bill Gates"
-    assert d.donation == [1000]
+    assert list(d.donation) == [1000]
 
 def test_donorCollection_class():
     """test donor collection"""
@@ -24,3 +32,250 @@ def test_donorCollection_class():
     assert d.num_donations == 1
     assert d.total_donations == 1234
     assert d.name == "Bill Gates"
+
+def test_donor_aggregates():
+    """running total, average, min and max"""
+    d = Donor("Paul")
+    assert d.total_donations == 0
+    assert d.min_donation is None
+    for amount in ("10.10", "0.20", "5.01"):
+        d.add_donation(Decimal(amount))
+    assert d.num_donations == 3
+    assert d.total_donations == Decimal("15.31")
+    assert isinstance(d.total_donations, Decimal)
+    assert d.avg_donation == Decimal("15.31") / 3
+    assert d.min_donation == Decimal("0.20")
+    assert d.max_donation == Decimal("10.10")
+    assert d.generate_report_row() == "|{:>12}|{:>12}|{:>12}|{}|".format(
+        "Paul", sum(d.donation), sum(d.donation) / 3, list(d.donation))
+
+def test_donor_rejected_donation():
+    """a donation that can't be added to the total leaves the donor as it was"""
+    d = Donor("x", Decimal("1.5"))
+    with pytest.raises(TypeError):
+        d.add_donation(0.5)
+    assert d.num_donations == 1
+    assert list(d.donation) == [Decimal("1.5")]
+    assert d.total_donations == Decimal("1.5")
+    assert d.min_donation == d.max_donation == Decimal("1.5")
+
+def test_donor_storage():
+    """int donations are a zero-copy memoryview, others fall back to a list"""
+    d = Donor("Bill", 1234)
+    view = d.donation
+    assert isinstance(view, memoryview)
+    assert view.readonly and view.format == "q"
+    d.add_donation(5678)
+    assert list(view) == [1234]
+    assert list(d.donation) == [1234, 5678]
+    d.add_donation(2 ** 70)
+    d.add_donation(0.5)
+    assert d.donation == (1234, 5678, 2 ** 70, 0.5)
+    assert d.total_donations == 1234 + 5678 + 2 ** 70 + 0.5
+    assert str(d) == "[Donor name = Bill, donations = [1234, 5678, {}, 0.5]]".format(
+        2 ** 70)
+
+def test_add_donations():
+    """add_donations gives the same donor as add_donation for each amount"""
+    batches = [[3, 1, 2], [2 ** 70, 5], [0.5, 7]]
+    one, bulk = Donor("Bill", 4), Donor("Bill", 4)
+    view = bulk.donation
+    for batch in batches:
+        for amount in batch:
+            one.add_donation(amount)
+        bulk.add_donations(batch)
+        assert list(bulk.donation) == list(one.donation)
+        assert (bulk.total_donations, bulk.min_donation, bulk.max_donation) == \
+            (one.total_donations, one.min_donation, one.max_donation)
+    assert list(view) == [4]
+    with pytest.raises(TypeError):
+        bulk.add_donations([1, Decimal("1.5")])
+    assert bulk.num_donations == one.num_donations
+
+def test_sqlite_collection(tmp_path):
+    """the SQLite collection matches the in-memory one and persists"""
+    path = str(tmp_path / "donors.db")
+    memory = DonorCollection()
+    with SqliteDonorCollection(path, batch_size=2) as d_c:
+        for c in (memory, d_c):
+            c.add_new_donor("Bill")
+            c.add_donation("Bill", 1234)
+            c.add_donation("Bill", 5678)
+            c.add_new_donor("Paul")
+            c.add_donation("Paul", 0.5)
+            c.add_donation("Paul", 2.0)
+            c.add_donation("Bill", 1)
+        with pytest.raises(ValueError):
+            d_c.add_new_donor("Bill")
+        with pytest.raises(KeyError):
+            d_c.add_donation("Nobody", 1)
+        assert d_c.generate_report() == memory.generate_report()
+
+    with SqliteDonorCollection(path) as d_c:
+        assert d_c.generate_report() == memory.generate_report()
+        assert list(d_c.get_donor("Bill").donation) == [1234, 5678, 1]
+        assert [d.name for d in d_c.donors()] == ["Bill", "Paul"]
+        d_c.add_donation("Paul", 3)
+    with SqliteDonorCollection(path) as d_c:
+        assert d_c.get_donor("Paul").donation == (0.5, 2.0, 3)
+
+def test_sqlite_commits(tmp_path):
+    """with batch_size=1 each call is committed, bad amounts fail early"""
+    path = str(tmp_path / "donors.db")
+    with SqliteDonorCollection(path, batch_size=1) as d_c:
+        d_c.add_new_donor("Bill")
+        d_c.add_donation("Bill", 12)
+        with pytest.raises(TypeError):
+            d_c.add_donation("Bill", Decimal("1.5"))
+        with SqliteDonorCollection(path) as other:
+            assert [list(d.donation) for d in other.donors()] == [[12]]
+    with SqliteDonorCollection(path) as d_c:
+        assert list(d_c.get_donor("Bill").donation) == [12]
+
+def test_sqlite_bad_amounts(tmp_path):
+    """amounts SQLite can't store fail early and leave it usable"""
+    path = str(tmp_path / "donors.db")
+    with SqliteDonorCollection(path, batch_size=2) as d_c:
+        d_c.add_new_donor("Bill")
+        d_c.add_donation("Bill", 2**63 - 1)
+        for amount in (2**70, -2**63 - 1, float("nan")):
+            with pytest.raises(ValueError):
+                d_c.add_donation("Bill", amount)
+        d_c.add_donation("Bill", 12)
+    with SqliteDonorCollection(path) as d_c:
+        assert list(d_c.get_donor("Bill").donation) == [2**63 - 1, 12]
+
+def test_sqlite_report_floats(tmp_path):
+    """report totals are added up the way Donor adds them"""
+    amounts = [0.1] * 10 + [1e16, 1.0, -1e16]
+    memory = DonorCollection()
+    memory.add_new_donor("Bill")
+    with SqliteDonorCollection(str(tmp_path / "donors.db")) as d_c:
+        d_c.add_new_donor("Bill")
+        for amount in amounts:
+            memory.add_donation("Bill", amount)
+            d_c.add_donation("Bill", amount)
+        assert d_c.generate_report() == memory.generate_report()
+
+def test_bulk_load(tmp_path):
+    """bulk_load reads CSV, JSON lines and iterables into both collections"""
+    rows = [("Bill", 1234), ("Paul", 10), ("Bill", 5678), ("Anna", 0.5),
+            ("Paul", 20)]
+    expected = DonorCollection()
+    for name, amount in rows:
+        if name not in [d.name for d in expected.donors()]:
+            expected.add_new_donor(name)
+        expected.add_donation(name, amount)
+
+    csv_path = tmp_path / "donations.csv"
+    csv_path.write_text("name,amount\n" + "".join(
+        "{},{}\n".format(name, amount) for name, amount in rows))
+    jsonl_path = tmp_path / "donations.jsonl"
+    jsonl_path.write_text("".join(
+        json.dumps({"name": name, "amount": amount}) + "\n"
+        for name, amount in rows))
+
+    for source in (csv_path, str(jsonl_path), rows):
+        progress = []
+        d_c = DonorCollection()
+        assert d_c.bulk_load(source, progress.append, chunk_size=2) == 5
+        assert progress == [2, 4, 5]
+        assert d_c.generate_report() == expected.generate_report()
+        assert d_c.get_donor("Bill").max_donation == 5678
+
+    d_c = DonorCollection()
+    assert d_c.bulk_load(rows * 10, chunk_size=4) == 50
+    assert list(d_c.get_donor("Bill").donation) == [1234, 5678] * 10
+    assert d_c.get_donor("Anna").total_donations == 5.0
+
+    bad_path = tmp_path / "bad.csv"
+    bad_path.write_text("donor,amount\nBill,10\n")
+    with pytest.raises(ValueError, match="name and amount"):
+        DonorCollection().bulk_load(bad_path)
+
+    memory = DonorCollection()
+    memory.add_new_donor("Paul")
+    memory.bulk_load(rows)
+    with SqliteDonorCollection(str(tmp_path / "donors.db")) as d_c:
+        d_c.add_new_donor("Paul")
+        assert d_c.bulk_load(csv_path, chunk_size=2) == 5
+        assert d_c.generate_report() == memory.generate_report()
+
+def test_bulk_load_errors(tmp_path):
+    """the rows before one that can't be read or added are added"""
+    csv_path = tmp_path / "donations.csv"
+    csv_path.write_text("name,amount\nA,1\nB,2\nC,abc\nD,4\nA,5\n")
+    jsonl_path = tmp_path / "donations.jsonl"
+    jsonl_path.write_text('{"name": "A", "amount": 1}\n'
+                          '{"name": "B", "amount": 2}\n'
+                          '{"name": "C", "amount": \n'
+                          '{"name": "D", "amount": 4}\n')
+    rows = [("A", 1), ("B", 2), ("C", "abc"), ("D", 4), ("A", 5)]
+    mixed = [("A", 1), ("B", Decimal(2)), ("B", 0.5), ("D", 4), ("A", 5)]
+    for source in (csv_path, jsonl_path, rows, mixed):
+        for chunk_size in (2, 100):
+            d_c = DonorCollection()
+            with pytest.raises((ValueError, TypeError)):
+                d_c.bulk_load(source, chunk_size=chunk_size)
+            assert [(d.name, list(d.donation)) for d in d_c.donors()] == [
+                ("A", [1]), ("B", [2])]
+
+    with SqliteDonorCollection(str(tmp_path / "donors.db")) as d_c:
+        for source in (csv_path, mixed):
+            with pytest.raises((ValueError, TypeError)):
+                d_c.bulk_load(source, chunk_size=100)
+        assert [(d.name, list(d.donation)) for d in d_c.donors()] == [
+            ("A", [1, 1]), ("B", [2])]
+
+def test_sqlite_bulk_load_rollback(tmp_path):
+    """donors added by a chunk that fails are rolled back with it"""
+    path = str(tmp_path / "donors.db")
+    with SqliteDonorCollection(path) as d_c:
+        d_c.add_new_donor("Bill")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TRIGGER unlucky BEFORE INSERT ON donations "
+                 "WHEN NEW.amount = 13 BEGIN SELECT RAISE(ABORT, 'no'); END")
+    conn.close()
+    with SqliteDonorCollection(path) as d_c:
+        with pytest.raises(sqlite3.IntegrityError):
+            d_c.bulk_load([("Bill", 1), ("Paul", 2), ("Paul", 13)])
+        with pytest.raises(KeyError):
+            d_c.add_donation("Paul", 3)
+        assert [d.name for d in d_c.donors()] == ["Bill"]
+        d_c.add_new_donor("Paul")
+        d_c.add_donation("Paul", 3)
+    with SqliteDonorCollection(path) as d_c:
+        assert [(d.name, list(d.donation)) for d in d_c.donors()] == [
+            ("Bill", []), ("Paul", [3])]
+
+def test_write_letters(tmp_path, capsys):
+    """letters are sharded into a directory or packed, without printing"""
+    d_c = DonorCollection()
+    d_c.bulk_load([("Bill", 1234), ("Paul", 10), ("Bill", 5), ("A/B", 1)])
+    bill = d_c.get_donor("Bill").letter()
+    assert d_c.write_letters(str(tmp_path / "out"), workers=2, batch_size=1) == 3
+    assert capsys.readouterr().out == ""
+    with open(os.path.join(str(tmp_path / "out"), letter_path("Bill"))) as f:
+        assert f.read() == bill
+    assert letter_path("A/B").endswith("/A%2FB")
+    assert os.path.exists(os.path.join(str(tmp_path / "out"), letter_path("A/B")))
+
+    names = ["", ".", "..", "...", "a/b", "a_b", "a\\b", "%2E", "%",
+             "\u00e9" * 100, "\u00e9" * 100 + "x", "x" + "\u00e9" * 100,
+             "x" * 255, "x" * 256]
+    assert len({letter_path(name).split("/")[1] for name in names}) == len(names)
+    assert max(len(letter_path(name).split("/")[1]) for name in names) == 255
+    odd = DonorCollection()
+    odd.bulk_load((name, 1) for name in names)
+    assert odd.write_letters(str(tmp_path / "odd")) == len(names)
+    for name in names:
+        assert os.path.isfile(os.path.join(str(tmp_path / "odd"), letter_path(name)))
+
+    assert d_c.write_letters(str(tmp_path / "zip"), archive="zip") == 3
+    with zipfile.ZipFile(str(tmp_path / "zip" / "letters.zip")) as f:
+        assert f.read(letter_path("Bill")).decode() == bill
+    assert d_c.write_letters(str(tmp_path / "tar"), archive="tar.gz") == 3
+    with tarfile.open(str(tmp_path / "tar" / "letters.tar.gz")) as f:
+        assert f.extractfile(letter_path("Bill")).read().decode() == bill
+    with pytest.raises(ValueError):
+        d_c.write_letters(str(tmp_path / "rar"), archive="rar")
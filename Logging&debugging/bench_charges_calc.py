@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for charges_calc on synthetic rental data
+'''
+import argparse
+import copy
+import datetime
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import charges_calc
+
+
+def make_rentals(count, seed=0):
+    """build a synthetic {id: record} dict shaped like source.json"""
+    rng = random.Random(seed)
+    data = {}
+    for index in range(count):
+        start = datetime.date(2016, 1, 1) + \
+            datetime.timedelta(days=rng.randrange(1000))
+        end = start + datetime.timedelta(days=rng.randrange(-100, 400))
+        data['RNT{:07d}'.format(index)] = {
+            'product_code': 'PRD{}'.format(rng.randrange(100)),
+            'units_rented': rng.randrange(-1, 10),
+            'price_per_day': rng.randrange(-5, 50),
+            'rental_start': '{}/{}/{:02d}'.format(start.month, start.day,
+                                                  start.year % 100),
+            'rental_end': '{}/{}/{:02d}'.format(end.month, end.day,
+                                                end.year % 100),
+        }
+    return data
+
+
+def strptime_dates(data):
+    """the original cost: every valid record parsed its dates four times"""
+    for value in data.values():
+        for _ in range(2):
+            for field in ('rental_start', 'rental_end'):
+                datetime.datetime.strptime(value[field], '%m/%d/%y')
+
+
+def parse_once_dates(data):
+    """one memoized parse per date field"""
+    parse = charges_calc.parse_rental_date
+    for value in data.values():
+        parse(value['rental_start'])
+        parse(value['rental_end'])
+
+
+def timed(label, func, *args):
+    """run func once and print the elapsed wall time"""
+    begin = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - begin
+    print('{:<40} {:>8.3f} s'.format(label, elapsed))
+    return elapsed
+
+
+def bench_dates(data):
+    """strptime against the cached fixed-format parser"""
+    charges_calc.parse_rental_date.cache_clear()
+    slow = timed('date parsing: strptime x4', strptime_dates, data)
+    fast = timed('date parsing: parse_rental_date x2', parse_once_dates,
+                 data)
+    print('{:<40} {:>8.1f} x'.format('speedup', slow / fast))
+
+
+def bench_calculate(data):
+    """full calculate_additional_fields run, per engine"""
+    charges_calc.parse_rental_date.cache_clear()
+    timed('calculate_additional_fields', charges_calc.calculate_additional_fields,
+          copy.deepcopy(data))
+    if charges_calc.np is None:
+        print('numpy not installed, skipping the numpy engine')
+        return
+    charges_calc.parse_rental_date.cache_clear()
+    timed('calculate_additional_fields_columnar',
+          charges_calc.calculate_additional_fields_columnar,
+          copy.deepcopy(data))
+
+
+def bench_parallel(data):
+    """serial against the process pool, with the parent's own CPU time
+
+    The pool can only win if the parent spends less CPU time than the
+    whole serial calculation; the rest is divided among the workers.
+    """
+    workers = max(2, len(os.sched_getaffinity(0))
+                  if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    charges_calc.parse_rental_date.cache_clear()
+    serial = timed('calculate_additional_fields',
+                   charges_calc.calculate_additional_fields,
+                   copy.deepcopy(data))
+    records = copy.deepcopy(data)
+    charges_calc.parse_rental_date.cache_clear()
+    cpu = time.process_time()
+    parallel = timed('parallel, {} workers'.format(workers),
+                     charges_calc.calculate_additional_fields_parallel,
+                     records, workers)
+    cpu = time.process_time() - cpu
+    print('{:<40} {:>8.3f} s'.format('parallel: parent CPU', cpu))
+    print('{:<40} {:>8.1f} x'.format('speedup', serial / parallel))
+
+
+def bench_backends(data):
+    """load through each installed JSON backend, then save"""
+    backends = ['json']
+    if charges_calc.orjson is not None:
+        backends.append('orjson')
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source.json')
+        with open(source, 'w') as file:
+            json.dump(data, file)
+        loaded = {}
+        for backend in backends:
+            def load():
+                loaded['data'] = charges_calc.load_rentals_file(
+                    source, backend)
+
+            timed('{}: load'.format(backend), load)
+        charges_calc.parse_rental_date.cache_clear()
+        timed('compute', charges_calc.calculate_additional_fields,
+              loaded['data'])
+        timed('json.dumps', json.dumps, loaded['data'])
+        for compact in (False, True):
+            timed('save' + (' compact' if compact else ''),
+                  charges_calc.save_to_json, os.path.join(tmp, 'out.json'),
+                  loaded['data'], compact)
+
+
+def bench_incremental(data):
+    """a full run against --incremental runs with none, 1% and all changed"""
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source.json')
+        options = dict(
+            input=source, output=os.path.join(tmp, 'out.json'),
+            state=os.path.join(tmp, 'out.state'), json='json', mmap=False,
+            compact=False, stream=False, slots=False, engine='python',
+            workers=1)
+        args = argparse.Namespace(incremental=True, **options)
+        profiler = charges_calc.StageProfiler(enabled=False)
+        with open(source, 'w') as file:
+            json.dump(data, file)
+        charges_calc.parse_rental_date.cache_clear()
+        timed('full run', charges_calc.run,
+              argparse.Namespace(incremental=False, **options), profiler)
+        timed('incremental: first run', charges_calc.run, args, profiler)
+        timed('incremental: unchanged', charges_calc.run, args, profiler)
+        changed = copy.deepcopy(data)
+        for key in list(changed)[::100]:
+            changed[key]['units_rented'] += 1
+        with open(source, 'w') as file:
+            json.dump(changed, file)
+        timed('incremental: 1% changed', charges_calc.run, args, profiler)
+        with open(source, 'w') as file:
+            json.dump(data, file, indent=1)
+        timed('incremental: reformatted input', charges_calc.run, args,
+              profiler)
+
+
+def bench_memory(data):
+    """bytes per calculated record held as dicts and as Rental objects"""
+    count = len(data)
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        records = charges_calc.calculate_additional_fields(
+            copy.deepcopy(data))
+        as_dicts = tracemalloc.get_traced_memory()[0] - base
+        charges_calc.pack_rentals(records)
+        as_slots = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    print('{:<40} {:>8.1f} B'.format('per record: dict', as_dicts / count))
+    print('{:<40} {:>8.1f} B'.format('per record: Rental', as_slots / count))
+
+
+BENCHMARKS = {
+    'dates': bench_dates,
+    'calculate': bench_calculate,
+    'parallel': bench_parallel,
+    'backends': bench_backends,
+    'incremental': bench_incremental,
+    'memory': bench_memory,
+}
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description='charges_calc benchmarks')
+    PARSER.add_argument('-n', '--records', type=int, default=1000000,
+                        help='number of synthetic records. Defaults to 1M')
+    PARSER.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run, from {}. Defaults to all'
+                        .format(', '.join(BENCHMARKS)))
+    ARGS = PARSER.parse_args()
+    for NAME in ARGS.benchmarks:
+        if NAME not in BENCHMARKS:
+            PARSER.error('unknown benchmark {!r}'.format(NAME))
+
+    logging.getLogger().disabled = True
+    DATA = make_rentals(ARGS.records)
+    print('{:,} records'.format(ARGS.records))
+    for name in ARGS.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](DATA)
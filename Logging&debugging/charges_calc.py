@@ -2,11 +2,94 @@
 Returns total price paid for individual rentals
 '''
 import argparse
+import cProfile
+import hashlib
 import json
 import datetime
 import math
+import mmap
 import logging
+import logging.handlers
+import marshal
+import multiprocessing
+import os
 import sys
+import tempfile
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from functools import partial
+from itertools import islice
+from operator import itemgetter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+READ_CHUNK_SIZE = 1 << 16
+# records per encoder call in save_to_json
+SAVE_CHUNK_SIZE = 1000
+# characters that can continue a JSON number
+NUMBER_CHARS = frozenset('0123456789+-.eE')
+DATE_FORMAT = '%m/%d/%y'
+DATE_CACHE_SIZE = 1 << 16
+ENGINES = ('python', 'numpy')
+JSON_BACKENDS = ('auto', 'json', 'orjson')
+# numbers below this keep every columnar product and quotient exact
+COLUMNAR_LIMIT = 1 << 31
+RECORD_FIELDS = ('rental_start', 'rental_end', 'price_per_day', 'units_rented')
+EPOCH = datetime.datetime(1970, 1, 1)
+# --incremental state file layout, bump when it changes
+STATE_VERSION = 2
+# marshal format of record fingerprints; versions 3+ write back-references
+# that depend on object identity, so equal records could differ in bytes
+MARSHAL_VERSION = 2
+# day number of an invalid date in the columnar engine
+BAD_DAY = -(1 << 62)
+# input record fields in file order, then the fields calculation adds
+RENTAL_FIELDS = ('product_code', 'units_rented', 'price_per_day',
+                 'rental_start', 'rental_end')
+CALCULATED_FIELDS = ('total_days', 'total_price', 'sqrt_total_price',
+                     'unit_cost')
+
+# warning logged for each reason an entry can be skipped, in check order
+SKIP_WARNINGS = {
+    'start_format': 'Unable to process entry %d because rental start ' +
+                    'is not in %%m/%%d/%%y format. Skipping...',
+    'end_format': 'Unable to process entry %d because rental end ' +
+                  'is not in %%m/%%d/%%y format. Skipping...',
+    'end_before_start': 'Unable to process entry %d because ' +
+                        'rental start > end. Skipping...',
+    'negative_price': 'Unable to process entry %d because ' +
+                      'price per day is negative. Skipping...',
+    'units_not_positive': 'Unable to process entry %d because ' +
+                          'units rented is non-positive. Skipping...',
+    'unexpected': 'Unexpected failure processing entry %d. Skipping',
+}
+SKIP_REASONS = tuple(SKIP_WARNINGS)
+# short form of each reason for the end of run summary
+SKIP_LABELS = {
+    'start_format': 'rental start not in %m/%d/%y format',
+    'end_format': 'rental end not in %m/%d/%y format',
+    'end_before_start': 'rental end < start',
+    'negative_price': 'price per day < 0',
+    'units_not_positive': 'units rented <= 0',
+    'unexpected': 'unexpected failure',
+}
 
 
 def parse_cmd_arguments():
@@ -17,8 +100,63 @@ def parse_cmd_arguments():
                         help='ouput JSON file')
     parser.add_argument('-d', '--debug', required=False,
                         help='log level. Can be 0-3. Defaults to 0')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='process records one at a time with flat memory')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes. Defaults to 1')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='python',
+                        help='calculation engine. Defaults to python')
+    parser.add_argument('-j', '--json', choices=JSON_BACKENDS, default='json',
+                        help='JSON library for loading the input: json, ' +
+                        'orjson, or auto for orjson when installed. ' +
+                        'orjson reads integers past 64 bits as floats. ' +
+                        'Defaults to json')
+    parser.add_argument('-c', '--compact', action='store_true',
+                        help='write output without spaces after separators')
+    parser.add_argument('-m', '--mmap', action='store_true',
+                        help='memory-map the input file instead of reading it')
+    parser.add_argument('--slots', action='store_true',
+                        help='hold records as compact Rental objects')
+    parser.add_argument('-I', '--incremental', action='store_true',
+                        help='only recompute records changed since the ' +
+                        'last incremental run')
+    parser.add_argument('--state', required=False,
+                        help='record state file for --incremental. ' +
+                        'Defaults to OUTPUT.state')
+    parser.add_argument('-p', '--profile', nargs='?', const='-',
+                        metavar='FILE',
+                        help='write per-stage timings as JSON to FILE, ' +
+                        'or stderr if no FILE is given')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='dump cProfile stats for the run to FILE')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.stream and args.workers > 1:
+        parser.error('--workers cannot be combined with --stream')
+    if args.engine == 'numpy':
+        if np is None:
+            parser.error('--engine numpy requires numpy to be installed')
+        if args.stream or args.workers > 1:
+            parser.error('--engine numpy cannot be combined with ' +
+                         '--stream or --workers')
+    if args.incremental and (args.stream or args.workers > 1 or
+                             args.engine != 'python'):
+        parser.error('--incremental cannot be combined with --stream, ' +
+                     '--workers or --engine')
+    if args.mmap and args.stream:
+        parser.error('--mmap cannot be combined with --stream')
+    if args.slots and (args.stream or args.incremental):
+        parser.error('--slots cannot be combined with --stream or ' +
+                     '--incremental')
+    if args.slots and args.json == 'orjson':
+        parser.error('--slots cannot be combined with --json orjson')
+    if args.json == 'orjson' and orjson is None:
+        parser.error('--json orjson requires orjson to be installed')
+    if args.state is None:
+        args.state = args.output + '.state'
+    return args
 
 
 def setup_logging(log_level):
@@ -55,13 +193,79 @@ def setup_logging(log_level):
         root_logger.disabled = True
 
 
-def load_rentals_file(filename):
-    """load input json file"""
+def _stdlib_loads(data, object_hook=None):
+    """stdlib json from str, bytes or any other buffer such as an mmap"""
+    if not isinstance(data, (str, bytes)):
+        # decode straight from the buffer rather than copying it to bytes
+        data = _decode(data)
+    return json.loads(data, object_hook=object_hook)
+
+
+def _orjson_loads(data):
+    """orjson, falling back to stdlib json for input orjson rejects
+
+    stdlib json also reads NaN, Infinity and numbers too large for a
+    double, so the backend does not change which files load. Integers
+    past 64 bits are the one difference: orjson reads them as floats.
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        logging.debug('orjson cannot read the input, retrying with json')
+        return _stdlib_loads(data)
+
+
+def _json_default(obj):
+    """serialize Rental records as their JSON dict while encoding"""
+    if isinstance(obj, Rental):
+        return obj.to_dict()
+    raise TypeError('Object of type {} is not JSON serializable'
+                    .format(type(obj).__name__))
+
+
+def get_json_loads(name='json', object_hook=None):
+    """the loads function for a JSON_BACKENDS name
+
+    It takes str, bytes or a buffer. 'auto' picks orjson when it is
+    installed and stdlib json otherwise, or when an object_hook is given
+    since orjson has none. Output is always written by stdlib json, so
+    it does not depend on the backend.
+    """
+    if name == 'auto':
+        name = 'json' if orjson is None or object_hook else 'orjson'
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('the orjson backend requires orjson')
+        if object_hook is not None:
+            raise ValueError('the orjson backend has no object_hook')
+        return _orjson_loads
+    if name == 'json':
+        if object_hook is not None:
+            return partial(_stdlib_loads, object_hook=object_hook)
+        return _stdlib_loads
+    raise ValueError('unknown JSON backend {!r}'.format(name))
+
+
+def load_rentals_file(filename, backend='json', use_mmap=False,
+                      object_hook=None):
+    """load input json file
+
+    The bytes read are decoded before parsing, so they are freed rather
+    than held alongside the records. With use_mmap the file is
+    memory-mapped and decoded from the mapped pages, so no private copy
+    of the raw input is made and concurrent runs share the OS page cache.
+    object_hook is passed on to json.loads, e.g. Rental.from_dict to
+    build records as they are parsed.
+    """
     logging.debug('Loading rental file %s', filename)
+    loads = get_json_loads(backend, object_hook)
     try:
-        with open(filename) as file:
+        with open(filename, 'rb') as file:
             try:
-                data = json.load(file)
+                if use_mmap:
+                    data = _load_mapped(file, loads)
+                else:
+                    data = loads(_read_text(file))
             except ValueError:
                 logging.error('File %s cannot be read as JSON', filename)
                 exit(0)
@@ -72,71 +276,838 @@ def load_rentals_file(filename):
     return data
 
 
-def validate_entry(value, index):
+def _decode(raw):
+    """the text of JSON bytes or a buffer, decoded the way json.loads would"""
+    # detect_encoding only looks at the first 4 bytes, which it needs as bytes
+    return str(raw, json.detect_encoding(bytes(raw[:4])), 'surrogatepass')
+
+
+def _read_text(file):
+    """the text of an open binary file, decoded the way json.loads would"""
+    return _decode(file.read())
+
+
+def _load_mapped(file, loads):
+    """parse an open binary file through a read-only memory map
+
+    Plain UTF-8 is parsed from the mapped pages; a BOM or UTF-16/32 input
+    is decoded first, as the plain path decodes it.
+    """
+    # an empty file cannot be mapped (ValueError), and is not JSON either
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            if json.detect_encoding(bytes(view[:4])) == 'utf-8':
+                return loads(view)
+            return loads(_decode(view))
+
+
+class Rental:
+    """compact __slots__ rental record
+
+    Item access mirrors the JSON dict it was built from, so the
+    calculation code works on either representation. Fields that were
+    never set behave like missing keys.
+    """
+    __slots__ = RENTAL_FIELDS + CALCULATED_FIELDS
+
+    def __getitem__(self, key):
+        if key not in _RENTAL_SLOTS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in _RENTAL_SLOTS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __repr__(self):
+        return 'Rental({!r})'.format(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, value):
+        """a Rental for a plain record dict, otherwise value unchanged
+
+        Only dicts with the input fields, optionally followed by the
+        calculated ones, in the usual order are converted, so anything
+        else keeps its own keys and key order. As a json object_hook it
+        converts each record as soon as it is parsed, so the dicts are
+        never all held at once.
+        """
+        if type(value) is not dict or len(value) < len(RENTAL_FIELDS):
+            return value
+        if tuple(value) != cls.__slots__[:len(value)]:
+            return value
+        rental = cls.__new__(cls)
+        for key, field in value.items():
+            setattr(rental, key, field)
+        return rental
+
+    def to_dict(self):
+        """the JSON dict shape, with keys in input then calculation order"""
+        value = {}
+        for key in self.__slots__:
+            try:
+                value[key] = getattr(self, key)
+            except AttributeError:
+                pass
+        return value
+
+
+_RENTAL_SLOTS = frozenset(Rental.__slots__)
+
+
+def pack_rentals(data):
+    """replace plain record dicts in data with Rental objects, in place"""
+    for key, value in data.items():
+        data[key] = Rental.from_dict(value)
+    return data
+
+
+def iter_rentals_file(filename, chunk_size=READ_CHUNK_SIZE):
+    """yield (rental_id, record) pairs from the top-level JSON object
+
+    The input is read in chunks and decoded one record at a time, so memory
+    stays bounded by the largest single record instead of the whole file.
+    """
+    logging.debug('Streaming rental file %s', filename)
+    decoder = json.JSONDecoder()
+    try:
+        with open(filename) as file:
+            reader = _RecordReader(file, decoder, chunk_size)
+            try:
+                reader.expect('{')
+                if reader.peek() == '}':
+                    reader.expect('}')
+                else:
+                    while True:
+                        key = reader.decode()
+                        if not isinstance(key, str):
+                            raise ValueError('object keys must be strings')
+                        reader.expect(':')
+                        yield key, reader.decode()
+                        if reader.peek() == ',':
+                            reader.expect(',')
+                            continue
+                        reader.expect('}')
+                        break
+                if reader.peek() != '':
+                    raise ValueError('extra data after top-level object')
+            except ValueError:
+                logging.error('File %s cannot be read as JSON', filename)
+                exit(0)
+    except IOError:
+        logging.error('File %s cannot be read (does not exist?)', filename)
+        exit(0)
+    logging.debug('Successfully streamed rental file %s', filename)
+
+
+class _RecordReader:
+    """chunked text buffer that decodes one JSON value at a time"""
+    def __init__(self, file, decoder, chunk_size):
+        self.file = file
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """drop consumed text and read the next chunk; False at end of file"""
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self):
+        """next non-whitespace character, or '' at end of file"""
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos] in ' \t\n\r'):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        """consume a structural character or raise ValueError"""
+        if self.peek() != char:
+            raise ValueError('expected {!r} at offset {}'.format(char, self.pos))
+        self.pos += 1
+
+    def decode(self):
+        """decode the next complete JSON value from the stream"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            # a number running into the end of the buffer may be truncated,
+            # e.g. '1.' decodes as 1 until the digits after it are read
+            if ((end == len(self.buffer) or self.buffer[end] in NUMBER_CHARS)
+                    and self._fill()):
+                continue
+            self.pos = end
+            return value
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_rental_date(text):
+    """parse a %m/%d/%y date, same result and errors as strptime
+
+    Plain m/d/yy strings are split and converted directly, skipping the
+    regex machinery behind strptime; anything else falls back to strptime
+    so unusual input is accepted or rejected exactly as before. Results
+    are memoized because rental dates repeat heavily across records.
+    """
+    if isinstance(text, str):
+        parts = text.split('/')
+        if len(parts) == 3:
+            month, day, year = parts
+            if (0 < len(month) < 3 and 0 < len(day) < 3 and len(year) == 2
+                    and text.isascii() and month.isdigit()
+                    and day.isdigit() and year.isdigit()):
+                # %y: 69-99 are 1969-1999, 00-68 are 2000-2068
+                year = int(year)
+                year += 1900 if year >= 69 else 2000
+                return datetime.datetime(year, int(month), int(day))
+    return datetime.datetime.strptime(text, DATE_FORMAT)
+
+
+def check_entry(value):
+    """check a rental record without logging
+
+    Returns (None, (rental_start, rental_end)) for a valid entry, so
+    callers do not parse the dates again, or (reason, None) where reason
+    is a key of SKIP_WARNINGS.
+    """
     try:
-        rental_start = datetime.datetime.strptime(value['rental_start'],
-                                                  '%m/%d/%y')
+        rental_start = parse_rental_date(value['rental_start'])
     except ValueError:
-        logging.warning('Unable to process entry %d because rental start ' +
-                        'is not in %%m/%%d/%%y format. Skipping...', index)
-        return False
+        return 'start_format', None
 
     try:
-        rental_end = datetime.datetime.strptime(value['rental_end'],
-                                                '%m/%d/%y')
+        rental_end = parse_rental_date(value['rental_end'])
     except ValueError:
-        logging.warning('Unable to process entry %d because rental end ' +
-                        'is not in %%m/%%d/%%y format. Skipping...', index)
-        return False
+        return 'end_format', None
 
     if rental_end < rental_start:
-        logging.warning('Unable to process entry %d because ' +
-                        'rental start > end. Skipping...', index)
-        return False
+        return 'end_before_start', None
 
     if value['price_per_day'] < 0:
-        logging.warning('Unable to process entry %d because ' +
-                        'price per day is negative. Skipping...', index)
-        return False
+        return 'negative_price', None
 
     if value['units_rented'] <= 0:
-        logging.warning('Unable to process entry %d because ' +
-                        'units rented is non-positive. Skipping...', index)
+        return 'units_not_positive', None
+
+    return None, (rental_start, rental_end)
+
+
+def validate_entry(value, index):
+    """check a rental record, logging a warning if it is skipped
+
+    Returns (rental_start, rental_end) as parsed datetimes for a valid
+    entry, or False otherwise.
+    """
+    reason, dates = check_entry(value)
+    if reason is not None:
+        logging.warning(SKIP_WARNINGS[reason], index)
         return False
+    return dates
+
+
+def _calculate(value):
+    """add the calculated fields in place; the skip reason or None"""
+    try:
+        reason, dates = check_entry(value)
+        if reason is not None:
+            return reason
+        rental_start, rental_end = dates
+        value['total_days'] = (rental_end - rental_start).days + 1
+        value['total_price'] = value['total_days'] * value['price_per_day']
+        value['sqrt_total_price'] = math.sqrt(value['total_price'])
+        value['unit_cost'] = value['total_price'] / value['units_rented']
+    except:
+        return 'unexpected'
+    return None
 
-    return True
+
+def _calculate_values(entries, skipped=None, results=None):
+    """hot loop shared by every per-record path, over (index, record) pairs
+
+    The debug check is made once up front, so a disabled logger costs
+    nothing per record. Skipped entries are only counted; their detail
+    is logged at debug level. If results is a list, what each record
+    gained is appended to it, see _calculated_fields.
+    """
+    if skipped is None:
+        skipped = Counter()
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for index, value in entries:
+        if debug:
+            logging.debug('Processing entry %d with value: %s', index, value)
+        reason = _calculate(value)
+        if reason is not None:
+            skipped[reason] += 1
+            if debug:
+                logging.debug(SKIP_WARNINGS[reason], index)
+        if results is not None:
+            results.append(_calculated_fields(value, reason))
+    return skipped
+
+
+def _calculated_fields(value, reason):
+    """the calculated fields of a record just passed to _calculate
+
+    A tuple of the CALCULATED_FIELDS values for a calculated record, None
+    for a skipped one (it was not changed), or a dict of the fields it
+    has after an unexpected failure, which can stop part way through.
+    """
+    if reason is None:
+        return (value['total_days'], value['total_price'],
+                value['sqrt_total_price'], value['unit_cost'])
+    if reason != 'unexpected':
+        return None
+    fields = {}
+    for key in CALCULATED_FIELDS:
+        try:
+            fields[key] = value[key]
+        except (KeyError, TypeError):
+            pass
+    return fields
+
+
+def _set_calculated_fields(value, fields):
+    """apply a _calculated_fields result to the parent's copy of a record"""
+    if type(fields) is tuple:
+        (value['total_days'], value['total_price'], value['sqrt_total_price'],
+         value['unit_cost']) = fields
+    elif fields is not None:
+        for key, field in fields.items():
+            value[key] = field
+
+
+def log_skip_summary(skipped):
+    """one warning line summarising the skipped entries per reason"""
+    if not skipped:
+        return
+    logging.warning('; '.join(
+        '{:,} skipped: {}'.format(skipped[reason], SKIP_LABELS[reason])
+        for reason in SKIP_REASONS if skipped[reason]))
 
 
 def calculate_additional_fields(data):
     logging.debug('Calculating additional fields for %d entries',
                   len(data.values()))
-    for index, value in enumerate(data.values()):
-        logging.debug('Processing entry %d with value: %s', index, value)
+    log_skip_summary(_calculate_values(enumerate(data.values())))
+
+    return data
+
+
+def _init_worker(log_queue, log_level, log_disabled):
+    """route a worker's log records back to the parent's handlers"""
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(log_level)
+    root_logger.disabled = log_disabled
+
+
+# the records of a parallel run, inherited by forked workers
+_SHARED_VALUES = None
+
+
+def _calculate_chunk(start, values):
+    """worker body: calculate one chunk, keeping the global entry index
+
+    Returns only what each record gained, see _calculated_fields, and the
+    skip counts, so the records themselves are not sent back.
+    """
+    results = []
+    skipped = _calculate_values(enumerate(values, start), results=results)
+    return results, skipped
+
+
+def _calculate_shared_chunk(start, stop):
+    """worker body for forked workers: a chunk of _SHARED_VALUES"""
+    return _calculate_chunk(start, _SHARED_VALUES[start:stop])
+
+
+def _forks():
+    """whether new processes are started with fork
+
+    Reads the configured start method without fixing it, falling back to
+    the platform default when none has been set yet.
+    """
+    method = (multiprocessing.get_start_method(allow_none=True) or
+              multiprocessing.get_all_start_methods()[0])
+    return method == 'fork'
+
+
+def calculate_additional_fields_parallel(data, workers, chunk_size=None):
+    """calculate_additional_fields spread over a pool of worker processes
+
+    Records are handed out in contiguous chunks and the calculated fields
+    are written back in their original order, so the result matches the
+    serial path exactly. Where the start method is fork, workers inherit the
+    records and only chunk bounds are sent to them; elsewhere the chunks
+    are pickled. Worker log records are forwarded through a queue to the
+    handlers configured by setup_logging.
+    """
+    global _SHARED_VALUES
+    logging.debug('Calculating additional fields for %d entries ' +
+                  'with %d workers', len(data), workers)
+    values = list(data.values())
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(values) // (workers * 4)))
+    starts = range(0, len(values), chunk_size)
+    context = multiprocessing.get_context()
+    if _forks():
+        task = _calculate_shared_chunk
+        chunks = [start + chunk_size for start in starts]
+        _SHARED_VALUES = values
+    else:
+        task = _calculate_chunk
+        chunks = [values[start:start + chunk_size] for start in starts]
+
+    root_logger = logging.getLogger()
+    log_queue = context.Queue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *root_logger.handlers, respect_handler_level=True)
+    listening = False
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers, mp_context=context,
+                initializer=_init_worker,
+                initargs=(log_queue, root_logger.level,
+                          root_logger.disabled)) as executor:
+            results = executor.map(task, starts, chunks)
+            # after map() started the workers, so none is forked with
+            # the listener thread running
+            listener.start()
+            listening = True
+            skipped = Counter()
+            index = 0
+            for chunk_results, chunk_skipped in results:
+                skipped.update(chunk_skipped)
+                for fields in chunk_results:
+                    # the common case of _set_calculated_fields, inlined
+                    if type(fields) is tuple:
+                        value = values[index]
+                        (value['total_days'], value['total_price'],
+                         value['sqrt_total_price'],
+                         value['unit_cost']) = fields
+                    elif fields is not None:
+                        _set_calculated_fields(values[index], fields)
+                    index += 1
+    finally:
+        _SHARED_VALUES = None
+        if listening:
+            listener.stop()
+        log_queue.close()
+
+    log_skip_summary(skipped)
+    return data
+
+
+def _is_plain_number(number):
+    """int or float small enough that float64 arithmetic is exact"""
+    if type(number) not in (int, float):
+        return False
+    return -COLUMNAR_LIMIT < number < COLUMNAR_LIMIT
+
+
+def _number_column(column):
+    """float64 array of an int/float column, or None if it does not fit
+
+    Also rejects nan, inf and ints too big to convert.
+    """
+    if not set(map(type, column)) <= {int, float}:
+        return None
+    try:
+        array = np.fromiter(column, dtype=np.float64, count=len(column))
+    except OverflowError:
+        return None
+    with np.errstate(invalid='ignore'):
+        if not np.all(np.abs(array) < COLUMNAR_LIMIT):
+            return None
+    return array
+
+
+def _date_column(column, date_days):
+    """int64 days since 1970 per date string, BAD_DAY where invalid"""
+    return np.fromiter(map(date_days.__getitem__, column), dtype=np.int64,
+                       count=len(column))
+
+
+def _split_columns(values):
+    """regular record indices, their field columns and the irregular indices
+
+    A record goes down the per-record path whenever any of its fields is
+    something the arrays cannot represent faithfully (missing keys,
+    non-string dates, bools, huge or non-finite numbers), so that its
+    result and skip reason are exactly those of the per-record path.
+    rows is None when every record is regular. The fields of all records
+    are fetched a column at a time at C speed; only if that fails, or a
+    column does not fit, are the records sorted one by one.
+    """
+    try:
+        columns = [list(map(itemgetter(key), values)) for key in RECORD_FIELDS]
+        if set(map(type, columns[0])) | set(map(type, columns[1])) <= {str}:
+            prices = _number_column(columns[2])
+            units = _number_column(columns[3])
+            if prices is not None and units is not None:
+                return None, columns, (prices, units), []
+    except (KeyError, TypeError):
+        pass
+
+    fields = itemgetter(*RECORD_FIELDS)
+    rows = []
+    irregular = []
+    columns = [[] for key in RECORD_FIELDS]
+    for index, value in enumerate(values):
         try:
-            if not validate_entry(value, index):
-                continue
-            rental_start = datetime.datetime.strptime(value['rental_start'],
-                                                      '%m/%d/%y')
-            rental_end = datetime.datetime.strptime(value['rental_end'],
-                                                    '%m/%d/%y')
-            value['total_days'] = (rental_end - rental_start).days + 1
-            value['total_price'] = value['total_days'] * value['price_per_day']
-            value['sqrt_total_price'] = math.sqrt(value['total_price'])
-            value['unit_cost'] = value['total_price'] / value['units_rented']
-        except:
-            logging.warning('Unexpected failure processing entry %d. Skipping',
-                            index)
+            row = fields(value)
+        except (KeyError, TypeError):
+            irregular.append(index)
             continue
+        if not (type(row[0]) is str and type(row[1]) is str and
+                _is_plain_number(row[2]) and _is_plain_number(row[3])):
+            irregular.append(index)
+            continue
+        rows.append(index)
+        for column, field in zip(columns, row):
+            column.append(field)
+    numbers = (_number_column(columns[2]), _number_column(columns[3]))
+    return rows, columns, numbers, irregular
+
+
+def _epoch_day(text):
+    """days since 1970-01-01 for a rental date, or BAD_DAY if it is invalid"""
+    try:
+        return (parse_rental_date(text) - EPOCH).days
+    except ValueError:
+        return BAD_DAY
+
+
+def _load_columns(values):
+    """load the records into NumPy arrays for the columnar engine"""
+    rows, (starts, ends, prices, _), (price_days, units), irregular = \
+        _split_columns(values)
+    # each distinct date string is parsed once
+    date_days = {text: _epoch_day(text) for text in set(starts) | set(ends)}
+    price_types = set(map(type, prices))
+    if price_types == {int}:
+        price_is_int = True
+    elif int not in price_types:
+        price_is_int = False
+    else:
+        price_is_int = np.fromiter((type(price) is int for price in prices),
+                                   dtype=bool, count=len(prices))
+    columns = {
+        'index': rows,
+        'start': _date_column(starts, date_days),
+        'end': _date_column(ends, date_days),
+        'price_per_day': price_days,
+        'price_is_int': price_is_int,
+        'units_rented': units,
+    }
+    return columns, irregular
+
+
+def calculate_additional_fields_columnar(data):
+    """calculate_additional_fields over NumPy column arrays
+
+    The fields are gathered into arrays in one pass, validation is done
+    as vectorized masks and the derived fields are computed in bulk, then
+    written back in one loop. Results and skip counts match the
+    per-record path; the per-entry 'Processing entry' debug lines are not
+    emitted.
+    """
+    if np is None:
+        raise ImportError('the numpy engine requires numpy')
+    logging.debug('Calculating additional fields for %d entries ' +
+                  'with the numpy engine', len(data))
+    values = list(data.values())
+    cols, irregular = _load_columns(values)
+
+    start_bad = cols['start'] == BAD_DAY
+    end_bad = cols['end'] == BAD_DAY
+    # masks in SKIP_REASONS order; reasons holds 1 + the reason position
+    masks = [start_bad, end_bad,
+             ~(start_bad | end_bad) & (cols['end'] < cols['start']),
+             cols['price_per_day'] < 0, cols['units_rented'] <= 0]
+    reasons = np.select(masks, np.arange(1, len(masks) + 1), default=0)
+    valid = reasons == 0
+    all_valid = bool(valid.all())
+
+    def valid_part(array):
+        return array if all_valid else array[valid]
+
+    # inf results are kept as the per-record path keeps them, silently
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        total_days = valid_part(cols['end']) - valid_part(cols['start']) + 1
+        total_price = total_days * valid_part(cols['price_per_day'])
+        sqrt_total_price = np.sqrt(total_price)
+        unit_cost = total_price / valid_part(cols['units_rented'])
+
+    # int prices give int totals, exact since they stay below 2 ** 53
+    price_is_int = cols['price_is_int']
+    if price_is_int is True:
+        total_prices = total_price.astype(np.int64).tolist()
+    else:
+        total_prices = total_price.tolist()
+        if price_is_int is not False:
+            for position in np.flatnonzero(valid_part(price_is_int)).tolist():
+                total_prices[position] = int(total_prices[position])
+
+    rows = cols['index']
+    if rows is None:
+        # every record is regular, so positions in the columns are indices
+        targets = values if all_valid else \
+            map(values.__getitem__, np.flatnonzero(valid).tolist())
+        rows = np.arange(len(values))
+    else:
+        rows = np.asarray(rows, dtype=np.int64)
+        targets = map(values.__getitem__, rows[valid].tolist())
+    for value, days, price, root, cost in zip(
+            targets, total_days.tolist(), total_prices,
+            sqrt_total_price.tolist(), unit_cost.tolist()):
+        value['total_days'] = days
+        value['total_price'] = price
+        value['sqrt_total_price'] = root
+        value['unit_cost'] = cost
+
+    counts = np.bincount(reasons, minlength=len(SKIP_REASONS) + 1)
+    skipped = Counter({reason: count for reason, count
+                       in zip(SKIP_REASONS, counts[1:].tolist()) if count})
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for index, reason in zip(rows[~valid].tolist(),
+                                 reasons[~valid].tolist()):
+            logging.debug(SKIP_WARNINGS[SKIP_REASONS[reason - 1]], index)
+    _calculate_values(((index, values[index]) for index in irregular),
+                      skipped)
+
+    log_skip_summary(skipped)
+    return data
+
+
+def _file_digest(filename):
+    """blake2b hex digest of a file's bytes, or None if it cannot be read"""
+    digest = hashlib.blake2b()
+    try:
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(READ_CHUNK_SIZE), b''):
+                digest.update(block)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def load_previous_run(output_filename, state_filename, compact=False):
+    """the state left by the last incremental run, plus its output bytes
+
+    A dict with 'keys', the rental ids in output order, 'inputs', the
+    marshal bytes of each input record, 'spans', an array of the start
+    and end offset of each "id": result item in 'output', the previous
+    output file's bytes, and 'input_digest'. The state holds the digest
+    of the output it was written with, so a state whose output was
+    rewritten since is ignored like a missing or unreadable one, and an
+    empty state is returned that makes everything recomputed.
+    """
+    try:
+        with open(state_filename, 'rb') as file:
+            # marshal.load reads a file object a few bytes at a time
+            state = marshal.loads(file.read())
+        with open(output_filename, 'rb') as file:
+            output = file.read()
+        spans = array('q', state['spans'])
+        usable = state['version'] == STATE_VERSION and \
+            state['compact'] == compact and \
+            state['output_digest'] == hashlib.blake2b(output).hexdigest() \
+            and len(state['keys']) == len(state['inputs']) == len(spans) // 2
+    except (IOError, EOFError, ValueError, TypeError, KeyError):
+        usable = False
+    if not usable:
+        logging.debug('No usable previous run in %s / %s, ' +
+                      'recomputing everything', output_filename,
+                      state_filename)
+        return {'keys': [], 'inputs': [], 'spans': array('q'),
+                'output': b'', 'input_digest': None}
+    return {'keys': state['keys'], 'inputs': state['inputs'], 'spans': spans,
+            'output': output, 'input_digest': state['input_digest']}
 
+
+def calculate_additional_fields_incremental(data, previous):
+    """calculate_additional_fields, skipping records unchanged since a last run
+
+    previous is the state from load_previous_run. A record is unchanged
+    when its marshal bytes equal the stored ones: a plain bytes compare
+    that, unlike ==, also tells 1 from 1.0 and True and notices reordered
+    keys, all of which change the output. Added or changed records are
+    recomputed; unchanged ones are left as loaded, as save_incremental
+    copies their results from the previous output. Returns (data,
+    records) where records is a pair of lists, the marshal bytes of every
+    record and its index in the previous run or None if recomputed. The
+    skip summary only covers the recomputed records.
+    """
+    keys = previous['keys']
+    inputs = previous['inputs']
+    count = len(keys)
+    # only built once the ids stop matching the previous order
+    indexes = None
+    fingerprints = []
+    sources = []
+    changed = []
+    for index, (key, value) in enumerate(data.items()):
+        fingerprint = marshal.dumps(value, MARSHAL_VERSION)
+        fingerprints.append(fingerprint)
+        source = index
+        if index >= count or keys[index] != key:
+            if indexes is None:
+                indexes = {key: source for source, key in enumerate(keys)}
+            source = indexes.get(key)
+        if source is not None and inputs[source] == fingerprint:
+            sources.append(source)
+        else:
+            sources.append(None)
+            changed.append((index, value))
+    logging.debug('Recomputing %d of %d entries, %d in the last run',
+                  len(changed), len(data), count)
+    log_skip_summary(_calculate_values(changed))
+
+    return data, (fingerprints, sources)
+
+
+def save_incremental(filename, state_filename, data, records, previous,
+                     input_digest, compact=False):
+    """save_to_json for an incremental run, then the state for the next one
+
+    Unchanged records keep their "id": result items from the previous
+    output, and runs of them that were adjacent there are copied with
+    one write; only recomputed records are serialized. The file is the
+    same as save_to_json writes. The state written to state_filename
+    holds every item's new span and the digests of the input and the
+    new output.
+    """
+    logging.debug('Saving results to %s', filename)
+    item_separator, key_separator = (',', ':') if compact else (', ', ': ')
+    encode = json.JSONEncoder(
+        separators=(item_separator, key_separator)).encode
+    encode_key = json.encoder.encode_basestring_ascii
+    separator = item_separator.encode('ascii')
+    fingerprints, sources = records
+    old_spans = previous['spans']
+    old_output = memoryview(previous['output'])
+    digest = hashlib.blake2b(b'{')
+    spans = array('q')
+    position = 1
+    # the span of the previous output still to be copied
+    copy_start = copy_end = None
+    try:
+        with replace_on_success(filename, 'wb') as file:
+            def write(chunk):
+                file.write(chunk)
+                digest.update(chunk)
+
+            file.write(b'{')
+            for (key, value), source in zip(data.items(), sources):
+                if spans:
+                    position += len(separator)
+                if source is None:
+                    if copy_end is not None:
+                        write(old_output[copy_start:copy_end])
+                        copy_start = copy_end = None
+                    if spans:
+                        write(separator)
+                    item = (encode_key(key) + key_separator +
+                            encode(value)).encode('ascii')
+                    write(item)
+                    length = len(item)
+                else:
+                    start = old_spans[2 * source]
+                    end = old_spans[2 * source + 1]
+                    # adjacent items are copied with the separator between
+                    if start - len(separator) == copy_end:
+                        copy_end = end
+                    else:
+                        if copy_end is not None:
+                            write(old_output[copy_start:copy_end])
+                        if spans:
+                            write(separator)
+                        copy_start, copy_end = start, end
+                    length = end - start
+                spans.append(position)
+                position += length
+                spans.append(position)
+            if copy_end is not None:
+                write(old_output[copy_start:copy_end])
+            write(b'}')
+    except IOError:
+        logging.error('File %s cannot be opened for write', filename)
+        exit(0)
+    logging.debug('Successfully saved results to %s', filename)
+
+    state = {'version': STATE_VERSION, 'compact': compact,
+             'input_digest': input_digest,
+             'output_digest': digest.hexdigest(), 'keys': list(data),
+             'inputs': fingerprints, 'spans': spans.tobytes()}
+    try:
+        with replace_on_success(state_filename, 'wb') as file:
+            file.write(marshal.dumps(state))
+    except IOError:
+        logging.error('File %s cannot be opened for write', state_filename)
+        exit(0)
     return data
 
 
-def save_to_json(filename, data):
-    """save output file JSON"""
+def calculate_additional_fields_stream(records):
+    """lazily calculate additional fields for (rental_id, record) pairs"""
+    skipped = Counter()
+    for index, (key, value) in enumerate(records):
+        _calculate_values(((index, value),), skipped)
+        yield key, value
+    log_skip_summary(skipped)
+
+
+def save_to_json(filename, data, compact=False):
+    """save output file JSON, in json.dump's layout unless compact
+
+    The C encoder turns SAVE_CHUNK_SIZE records at a time into text that
+    is written straight away, so the whole output is never held in
+    memory. (json.dump streams too, but through the pure Python encoder,
+    which is several times slower.) The file only replaces filename once
+    every record is written.
+    """
     logging.debug('Saving results to %s', filename)
+    item_separator, key_separator = (',', ':') if compact else (', ', ': ')
+    encode = json.JSONEncoder(separators=(item_separator, key_separator),
+                              default=_json_default).encode
+    items = iter(data.items())
     try:
-        with open(filename, 'w') as file:
-            json.dump(data, file)
+        with replace_on_success(filename, 'wb') as file:
+            file.write(b'{')
+            separator = b''
+            while True:
+                chunk = dict(islice(items, SAVE_CHUNK_SIZE))
+                if not chunk:
+                    break
+                file.write(separator)
+                # the chunk's items without its braces
+                file.write(encode(chunk)[1:-1].encode('ascii'))
+                separator = item_separator.encode('ascii')
+            file.write(b'}')
     except IOError:
         logging.error('File %s cannot be opened for write', filename)
         exit(0)
@@ -144,9 +1115,194 @@ def save_to_json(filename, data):
     return data
 
 
+@contextmanager
+def replace_on_success(filename, mode='w'):
+    """open a temporary file that replaces filename when the block succeeds
+
+    The file is created next to filename, so os.replace is atomic. If the
+    block raises, or calls exit() after a read error, the temporary file
+    is removed and filename is left as it was.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(filename) + '.',
+        suffix='.tmp')
+    try:
+        # mkstemp creates the file 0600; give it the mode open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_name, 0o666 & ~umask)
+        with open(fd, mode) as file:
+            yield file
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+
+def save_records_to_json(filename, records):
+    """save (rental_id, record) pairs as they arrive
+
+    Produces the same bytes as save_to_json for the same records. The
+    output is written to a temporary file and only replaces filename once
+    every record was read, so bad input leaves the old output in place.
+    """
+    logging.debug('Streaming results to %s', filename)
+    count = 0
+    try:
+        with replace_on_success(filename) as file:
+            file.write('{')
+            for key, value in records:
+                if count:
+                    file.write(', ')
+                file.write(json.dumps(key))
+                file.write(': ')
+                file.write(json.dumps(value))
+                count += 1
+            file.write('}')
+    except IOError:
+        logging.error('File %s cannot be opened for write', filename)
+        exit(0)
+    logging.debug('Successfully streamed %d results to %s', count, filename)
+    return count
+
+
+def _peak_rss_kb():
+    """peak resident set size of this process so far, in KiB, or None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _cpu_seconds():
+    """CPU time of this process and its finished children"""
+    children = os.times()
+    return time.process_time() + \
+        children.children_user + children.children_system
+
+
+class StageProfiler:
+    """wall time, CPU time, peak RSS and throughput per pipeline stage"""
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """measure the with block; set info['records'] inside it"""
+        info = {'records': None}
+        if not self.enabled:
+            yield info
+            return
+        wall = time.perf_counter()
+        cpu = _cpu_seconds()
+        yield info
+        wall = time.perf_counter() - wall
+        records = info['records']
+        self.stages.append({
+            'stage': name,
+            'wall_s': wall,
+            'cpu_s': _cpu_seconds() - cpu,
+            'peak_rss_kb': _peak_rss_kb(),
+            'records': records,
+            'records_per_s': records / wall if records and wall else None,
+        })
+
+    def report(self, filename, args=None):
+        """write the collected stages as JSON to filename, '-' for stderr
+
+        stderr keeps the report apart from the log lines on stdout.
+        """
+        report = {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'args': vars(args) if args is not None else None,
+            'stages': self.stages,
+            'total_wall_s': sum(stage['wall_s'] for stage in self.stages),
+            'total_cpu_s': sum(stage['cpu_s'] for stage in self.stages),
+            'peak_rss_kb': _peak_rss_kb(),
+        }
+        text = json.dumps(report, indent=2)
+        if filename == '-':
+            print(text, file=sys.stderr)
+            return
+        try:
+            with open(filename, 'w') as file:
+                file.write(text + '\n')
+        except IOError:
+            logging.error('File %s cannot be opened for write', filename)
+
+
+def run(args, profiler):
+    """the load, calculate and save pipeline selected by args"""
+    if args.stream:
+        with profiler.stage('stream') as stage:
+            records = iter_rentals_file(args.input)
+            records = calculate_additional_fields_stream(records)
+            stage['records'] = save_records_to_json(args.output, records)
+        return
+
+    if args.incremental:
+        run_incremental(args, profiler)
+        return
+
+    with profiler.stage('load_rentals_file') as stage:
+        data = load_rentals_file(args.input, args.json, args.mmap,
+                                 Rental.from_dict if args.slots else None)
+        stage['records'] = len(data)
+
+    with profiler.stage('calculate_additional_fields') as stage:
+        if args.engine == 'numpy':
+            data = calculate_additional_fields_columnar(data)
+        elif args.workers > 1:
+            data = calculate_additional_fields_parallel(data, args.workers)
+        else:
+            data = calculate_additional_fields(data)
+        stage['records'] = len(data)
+
+    with profiler.stage('save_to_json') as stage:
+        save_to_json(args.output, data, args.compact)
+        stage['records'] = len(data)
+
+
+def run_incremental(args, profiler):
+    """the --incremental pipeline, stopping early if the input is unchanged"""
+    with profiler.stage('load_previous_run') as stage:
+        previous = load_previous_run(args.output, args.state, args.compact)
+        digest = _file_digest(args.input)
+        stage['records'] = len(previous['keys'])
+    if digest is not None and digest == previous['input_digest']:
+        logging.debug('Input %s unchanged since the last run, keeping %s',
+                      args.input, args.output)
+        return
+
+    with profiler.stage('load_rentals_file') as stage:
+        data = load_rentals_file(args.input, args.json, args.mmap)
+        stage['records'] = len(data)
+
+    with profiler.stage('calculate_additional_fields') as stage:
+        data, records = calculate_additional_fields_incremental(data, previous)
+        stage['records'] = len(data)
+
+    with profiler.stage('save_to_json') as stage:
+        save_incremental(args.output, args.state, data, records, previous,
+                         digest, args.compact)
+        stage['records'] = len(data)
+
+
 if __name__ == "__main__":
     args = parse_cmd_arguments()
     setup_logging(args.debug)
-    data = load_rentals_file(args.input)
-    data = calculate_additional_fields(data)
-    save_to_json(args.output, data)
+    profiler = StageProfiler(enabled=args.profile is not None)
+    c_profile = cProfile.Profile() if args.cprofile else None
+    if c_profile is not None:
+        c_profile.enable()
+    try:
+        run(args, profiler)
+    finally:
+        if c_profile is not None:
+            c_profile.disable()
+            c_profile.dump_stats(args.cprofile)
+    if args.profile is not None:
+        profiler.report(args.profile, args)
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+'''
+pytest for charges_calc
+'''
+import argparse
+import copy
+import datetime
+import json
+import logging
+import warnings
+
+import pytest
+
+import charges_calc
+
+
+RENTALS = {
+    'RNT001': {'product_code': 'PRD80', 'units_rented': 8,
+               'price_per_day': 31, 'rental_start': '6/12/17',
+               'rental_end': '3/22/17'},
+    'RNT002': {'product_code': 'PRD11', 'units_rented': 1,
+               'price_per_day': 16.25, 'rental_start': '7/20/16',
+               'rental_end': '9/30/18'},
+    'RNT003': {'product_code': 'café "quoted" \\ \n☃',
+               'units_rented': 3, 'price_per_day': 1.5e-3,
+               'rental_start': '1/1/18', 'rental_end': '12/31/18'},
+    'RNT004': {'product_code': 'PRD4', 'units_rented': -2,
+               'price_per_day': 12345678901234567890,
+               'rental_start': 'bad', 'rental_end': '1/1/18'},
+    'RNT😀': {'nested': [1, -2.5E+3, True, None, {'a': []}],
+                        'units_rented': 1},
+}
+
+
+def write_json(path, data, **kwargs):
+    """dump data to path and return the path as a string"""
+    with open(str(path), 'w') as file:
+        json.dump(data, file, **kwargs)
+    return str(path)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, charges_calc.READ_CHUNK_SIZE])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_iter_rentals_file_chunks(tmp_path, chunk_size, indent):
+    """records split at any chunk boundary decode like json.load"""
+    path = write_json(tmp_path / 'in.json', RENTALS, indent=indent)
+    records = list(charges_calc.iter_rentals_file(path, chunk_size))
+    assert records == list(RENTALS.items())
+
+
+def test_iter_rentals_file_raw_escapes(tmp_path):
+    """escapes and raw non-ASCII text survive chunking"""
+    path = tmp_path / 'in.json'
+    path.write_text('{"a\\u00e9": {"s": "x\\"y\\\\z\\ud83d\\ude00☃"},'
+                    '"b":{}}', encoding='utf-8')
+    records = list(charges_calc.iter_rentals_file(str(path), 1))
+    assert records == [('aé', {'s': 'x"y\\z😀☃'}),
+                       ('b', {})]
+
+
+def test_iter_rentals_file_empty_object(tmp_path):
+    """an empty top-level object yields nothing"""
+    path = tmp_path / 'in.json'
+    path.write_text(' { } ')
+    assert list(charges_calc.iter_rentals_file(str(path), 1)) == []
+
+
+@pytest.mark.parametrize('text', [
+    '', '[]', '{"a": 1', '{"a": 1,}', '{"a" 1}', '{1: 2}', '{"a": 1} x',
+    '{"a": {"b": 1}', '{"a": tru}', '{"a": "open'])
+def test_iter_rentals_file_malformed(tmp_path, text):
+    """malformed input logs an error and exits"""
+    path = tmp_path / 'in.json'
+    path.write_text(text)
+    with pytest.raises(SystemExit):
+        list(charges_calc.iter_rentals_file(str(path), 1))
+
+
+def test_stream_matches_serial(caplog):
+    """the lazy pipeline gives the records and summary of the serial path"""
+    expected = charges_calc.calculate_additional_fields(calculation_cases())
+    summary = caplog.text
+    caplog.clear()
+    records = charges_calc.calculate_additional_fields_stream(
+        iter(calculation_cases().items()))
+    assert json.dumps(dict(records)) == json.dumps(expected)
+    assert caplog.text == summary
+
+
+def test_stream_keeps_output_on_bad_input(tmp_path):
+    """--stream only replaces the output once the whole input was read"""
+    good = write_json(tmp_path / 'good.json', RENTALS)
+    output = tmp_path / 'out.json'
+    records = charges_calc.iter_rentals_file(good)
+    charges_calc.save_records_to_json(str(output), records)
+    expected = output.read_bytes()
+    assert json.loads(expected) == json.loads(json.dumps(RENTALS))
+
+    bad = tmp_path / 'bad.json'
+    bad.write_text(json.dumps(RENTALS)[:200])
+    records = charges_calc.iter_rentals_file(str(bad), 16)
+    with pytest.raises(SystemExit):
+        charges_calc.save_records_to_json(str(output), records)
+    assert output.read_bytes() == expected
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['bad.json', 'good.json', 'out.json']
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('chunk_size', [1, 3, charges_calc.SAVE_CHUNK_SIZE])
+def test_save_to_json(tmp_path, compact, chunk_size, monkeypatch):
+    """chunked output has json.dumps's bytes, for dicts and Rentals"""
+    monkeypatch.setattr(charges_calc, 'SAVE_CHUNK_SIZE', chunk_size)
+    separators = (',', ':') if compact else None
+    output = str(tmp_path / 'out.json')
+    for data in ({}, copy.deepcopy(RENTALS)):
+        expected = json.dumps(data, separators=separators).encode('ascii')
+        charges_calc.save_to_json(output, data, compact)
+        assert (tmp_path / 'out.json').read_bytes() == expected
+    rentals = {'RNT001': RENTALS['RNT001'], 'RNT002': RENTALS['RNT002']}
+    expected = json.dumps(rentals, separators=separators).encode('ascii')
+    charges_calc.save_to_json(output, charges_calc.pack_rentals(
+        copy.deepcopy(rentals)), compact)
+    assert (tmp_path / 'out.json').read_bytes() == expected
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_json_backends_agree(tmp_path, use_mmap):
+    """orjson loads what json loads, falling back for NaN and huge floats"""
+    pytest.importorskip('orjson')
+    path = tmp_path / 'in.json'
+    path.write_text('{"RNT\u00e9": {"price_per_day": 1e16, "units": 2.5, '
+                    '"code": "caf\u00e9 \u2603"}, '
+                    '"RNT002": {"price_per_day": NaN, "units": 1e400}}')
+    loaded = [charges_calc.load_rentals_file(str(path), backend, use_mmap)
+              for backend in ('json', 'orjson')]
+    assert repr(loaded[0]) == repr(loaded[1])
+    del loaded[0]['RNT002']
+    charges_calc.save_to_json(str(tmp_path / 'out.json'), loaded[0], True)
+    assert (tmp_path / 'out.json').read_bytes() == \
+        b'{"RNT\\u00e9":{"price_per_day":1e+16,"units":2.5,' \
+        b'"code":"caf\\u00e9 \\u2603"}}'
+
+
+@pytest.mark.parametrize('encoding', ['utf-8', 'utf-8-sig', 'utf-16',
+                                      'utf-32-be'])
+def test_load_encodings(tmp_path, encoding):
+    """with or without mmap, input is decoded the way json.loads does"""
+    path = tmp_path / 'in.json'
+    path.write_text(json.dumps(RENTALS, ensure_ascii=False),
+                    encoding=encoding)
+    for use_mmap in (False, True):
+        assert charges_calc.load_rentals_file(
+            str(path), use_mmap=use_mmap) == RENTALS
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+@pytest.mark.parametrize('content', [b'', b'not json', None])
+def test_load_bad_files(tmp_path, caplog, use_mmap, content):
+    """empty, non-JSON and missing files log an error and exit"""
+    path = tmp_path / 'in.json'
+    if content is not None:
+        path.write_bytes(content)
+    with pytest.raises(SystemExit):
+        charges_calc.load_rentals_file(str(path), use_mmap=use_mmap)
+    message = 'cannot be read (does not exist?)' if content is None \
+        else 'cannot be read as JSON'
+    assert [record.getMessage() for record in caplog.records] == \
+        ['File {} {}'.format(path, message)]
+
+
+def test_load_rentals_as_slots(tmp_path):
+    """Rental.from_dict as object_hook builds records while parsing"""
+    path = write_json(tmp_path / 'in.json', RENTALS)
+    data = charges_calc.load_rentals_file(
+        path, object_hook=charges_calc.Rental.from_dict)
+    assert [type(value).__name__ for value in data.values()] == \
+        ['Rental', 'Rental', 'Rental', 'Rental', 'dict']
+    assert data['RNT😀'] == RENTALS['RNT😀']
+    charges_calc.calculate_additional_fields(data)
+    charges_calc.save_to_json(str(tmp_path / 'out.json'), data)
+    assert (tmp_path / 'out.json').read_bytes() == full_run(RENTALS)
+
+
+def test_skip_summary(caplog):
+    """skipped entries give one summary warning, their detail is debug"""
+    data = copy.deepcopy(RENTALS)
+    for index in range(1000):
+        data['END{}'.format(index)] = dict(RENTALS['RNT001'])
+    charges_calc.calculate_additional_fields(data)
+    assert [(record.levelno, record.getMessage())
+            for record in caplog.records] == [
+                (logging.WARNING,
+                 '1 skipped: rental start not in %m/%d/%y format; '
+                 '1,001 skipped: rental end < start; '
+                 '1 skipped: unexpected failure')]
+
+    caplog.clear()
+    caplog.set_level(logging.DEBUG)
+    charges_calc.calculate_additional_fields(copy.deepcopy(RENTALS))
+    loud = [record.getMessage() for record in caplog.records
+            if record.levelno >= logging.WARNING]
+    assert loud == ['1 skipped: rental start not in %m/%d/%y format; '
+                    '1 skipped: rental end < start; '
+                    '1 skipped: unexpected failure']
+    assert 'Unable to process entry 0 because rental start > end. ' \
+        'Skipping...' in caplog.messages
+
+
+def strptime_result(text):
+    """strptime's date for text, or the type of error it raises"""
+    try:
+        return datetime.datetime.strptime(text, charges_calc.DATE_FORMAT)
+    except (ValueError, TypeError) as error:
+        return type(error)
+
+
+@pytest.mark.parametrize('text', [
+    '1/1/18', '01/01/18', '12/31/99', '2/29/16', '1/1/68', '1/1/69',
+    '1/1/00', ' 1/1/18', '1/1/18 ', '1/1/2018', '2/29/17', '0/1/18',
+    '13/1/18', '1/0/18', '1/32/18', '1/1/1', '001/1/18', '1//18', '1/1',
+    '1/1/18/1', '', '+1/1/18', '\u0661/1/18', '1/\u00b2/18', 'bad'])
+def test_parse_rental_date_matches_strptime(text):
+    """the fast parser gives strptime's result, or its error"""
+    try:
+        result = charges_calc.parse_rental_date(text)
+    except (ValueError, TypeError) as error:
+        result = type(error)
+    assert result == strptime_result(text)
+
+
+def test_validate_entry_returns_dates(caplog):
+    """validate_entry gives the parsed dates, or False with a warning"""
+    value = dict(RENTALS['RNT002'])
+    assert charges_calc.validate_entry(value, 1) == (
+        datetime.datetime(2016, 7, 20), datetime.datetime(2018, 9, 30))
+    assert caplog.text == ''
+    assert charges_calc.validate_entry(dict(RENTALS['RNT001']), 0) is False
+    assert [record.getMessage() for record in caplog.records] == [
+        'Unable to process entry 0 because rental start > end. Skipping...']
+
+
+def calculation_cases():
+    """records covering every skip reason and a failure part way through"""
+    data = copy.deepcopy(RENTALS)
+    data['RNT005'] = {'product_code': 'PRD5', 'units_rented': 2,
+                      'price_per_day': 10 ** 400, 'rental_start': '1/1/18',
+                      'rental_end': '1/2/18'}
+    data['RNT006'] = {'product_code': 'PRD6', 'units_rented': 0,
+                      'price_per_day': 3, 'rental_start': '1/1/18',
+                      'rental_end': '1/2/18'}
+    data['RNT007'] = {'product_code': 'PRD7', 'units_rented': 1,
+                      'price_per_day': -3, 'rental_start': '1/1/18',
+                      'rental_end': '1/2/18'}
+    data['RNT008'] = {'product_code': 'PRD8', 'units_rented': 1,
+                      'price_per_day': 3, 'rental_start': '1/1/18',
+                      'rental_end': '2/30/18'}
+    for index in range(50):
+        data['GEN{:03d}'.format(index)] = {
+            'product_code': 'PRD', 'units_rented': index % 7 - 1,
+            'price_per_day': index * 1.5 if index % 3 else index - 10,
+            'rental_start': '{}/{}/17'.format(index % 12 + 1, index % 28 + 1),
+            'rental_end': '{}/{}/18'.format(index % 5 + 1, index % 27 + 1)}
+    return data
+
+
+def test_parallel_matches_serial():
+    """the process pool gives the same records, key order included"""
+    expected = charges_calc.calculate_additional_fields(calculation_cases())
+    assert 'total_price' in expected['RNT005']
+    assert 'sqrt_total_price' not in expected['RNT005']
+    result = charges_calc.calculate_additional_fields_parallel(
+        calculation_cases(), 3, chunk_size=7)
+    assert json.dumps(result) == json.dumps(expected)
+
+
+def test_parallel_start_method(monkeypatch):
+    """records are only inherited when the start method is fork"""
+    import multiprocessing
+    monkeypatch.setattr(multiprocessing, 'get_start_method',
+                        lambda allow_none=False: 'spawn')
+    assert not charges_calc._forks()
+    monkeypatch.setattr(multiprocessing, 'get_start_method',
+                        lambda allow_none=False: 'fork')
+    assert charges_calc._forks()
+
+    # the pickling path gives the same records
+    monkeypatch.setattr(charges_calc, '_forks', lambda: False)
+    expected = charges_calc.calculate_additional_fields(calculation_cases())
+    result = charges_calc.calculate_additional_fields_parallel(
+        calculation_cases(), 2, chunk_size=7)
+    assert json.dumps(result) == json.dumps(expected)
+
+
+def test_parallel_chunk_results():
+    """workers send back only the calculated fields"""
+    data = calculation_cases()
+    values = list(data.values())
+    results, skipped = charges_calc._calculate_chunk(0, copy.deepcopy(values))
+    assert skipped == charges_calc._calculate_values(
+        enumerate(copy.deepcopy(values)))
+    for value, fields in zip(values, results):
+        assert fields is None or isinstance(fields, (tuple, dict))
+        charges_calc._set_calculated_fields(value, fields)
+    assert json.dumps(data) == json.dumps(
+        charges_calc.calculate_additional_fields(calculation_cases()))
+
+
+def regular_cases(price):
+    """records that all fit the numpy columns, priced by price(index)"""
+    data = {}
+    for index in range(200):
+        data['REG{:03d}'.format(index)] = {
+            'product_code': 'PRD', 'units_rented': index % 5 - 1,
+            'price_per_day': price(index),
+            'rental_start': '{}/{}/{:02d}'.format(
+                index % 13 + 1, index % 31 + 1, index % 100),
+            'rental_end': '{}/{}/{:02d}'.format(
+                index % 12 + 1, index % 29 + 1, (index + 1) % 100)}
+    return data
+
+
+@pytest.mark.parametrize('cases', [
+    calculation_cases,
+    lambda: regular_cases(lambda index: index - 20),
+    lambda: regular_cases(lambda index: index * 0.75 - 20),
+    lambda: regular_cases(lambda index: index if index % 2 else index * 0.5),
+    lambda: {},
+])
+def test_columnar_matches_serial(cases, caplog):
+    """the numpy engine gives the same records and skip summary"""
+    pytest.importorskip('numpy')
+    expected = charges_calc.calculate_additional_fields(cases())
+    summary = caplog.text
+    caplog.clear()
+    result = charges_calc.calculate_additional_fields_columnar(cases())
+    assert json.dumps(result) == json.dumps(expected)
+    assert caplog.text == summary
+
+
+def test_columnar_no_float_warnings():
+    """a subnormal units_rented gives inf quietly, as the serial path does"""
+    pytest.importorskip('numpy')
+    data = regular_cases(lambda index: index + 1)
+    data['REG001']['units_rented'] = 5e-324
+    expected = charges_calc.calculate_additional_fields(copy.deepcopy(data))
+    assert expected['REG001']['unit_cost'] == float('inf')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        result = charges_calc.calculate_additional_fields_columnar(data)
+    assert json.dumps(result) == json.dumps(expected)
+
+
+def run_incremental(tmp_path, data, compact=False):
+    """one --incremental run over data, returning the output bytes"""
+    args = argparse.Namespace(
+        input=write_json(tmp_path / 'in.json', data),
+        output=str(tmp_path / 'out.json'), state=str(tmp_path / 'out.state'),
+        json='json', mmap=False, compact=compact)
+    charges_calc.run_incremental(args, charges_calc.StageProfiler(False))
+    return (tmp_path / 'out.json').read_bytes()
+
+
+def full_run(data, compact=False):
+    """the output bytes of a plain run over data"""
+    data = charges_calc.calculate_additional_fields(copy.deepcopy(data))
+    separators = (',', ':') if compact else None
+    return json.dumps(data, separators=separators).encode('ascii')
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_incremental_matches_full_run(tmp_path, compact, monkeypatch):
+    """reused and recomputed records give the bytes of a full run"""
+    data = calculation_cases()
+    assert run_incremental(tmp_path, data, compact) == full_run(data, compact)
+
+    data['RNT001']['units_rented'] = 3
+    data['RNT006']['price_per_day'] = 3.0
+    data['RNT007'] = dict(reversed(list(data['RNT007'].items())))
+    del data['GEN010']
+    data['NEW'] = dict(data['GEN011'])
+    expected = full_run(data, compact)
+    recomputed = []
+    calculate = charges_calc._calculate_values
+
+    def spy(entries):
+        entries = list(entries)
+        recomputed.extend(index for index, _ in entries)
+        return calculate(entries)
+    monkeypatch.setattr(charges_calc, '_calculate_values', spy)
+    assert run_incremental(tmp_path, data, compact) == expected
+    assert recomputed == [0, 6, 7, len(data) - 1]
+
+    data = dict(reversed(list(data.items())))
+    expected = full_run(data, compact)
+    del recomputed[:]
+    assert run_incremental(tmp_path, data, compact) == expected
+    assert recomputed == []
+
+
+def test_incremental_ignores_stale_state(tmp_path):
+    """a state whose output was rewritten since is not reused"""
+    data = calculation_cases()
+    run_incremental(tmp_path, data)
+    (tmp_path / 'out.json').write_bytes(full_run({'RNT': RENTALS['RNT001']}))
+    previous = charges_calc.load_previous_run(
+        str(tmp_path / 'out.json'), str(tmp_path / 'out.state'))
+    assert previous['keys'] == [] and previous['input_digest'] is None
+    assert run_incremental(tmp_path, data) == full_run(data)
+
+
+def test_incremental_unchanged_input(tmp_path, monkeypatch):
+    """an unchanged input stops before loading anything"""
+    data = calculation_cases()
+    expected = run_incremental(tmp_path, data)
+    monkeypatch.setattr(charges_calc, 'load_rentals_file', None)
+    assert run_incremental(tmp_path, data) == expected
+
+
+def test_profile_report_to_stderr(capsys):
+    """-p without a FILE leaves stdout to the log lines"""
+    profiler = charges_calc.StageProfiler()
+    with profiler.stage('load_rentals_file') as stage:
+        stage['records'] = 3
+    profiler.report('-')
+    captured = capsys.readouterr()
+    assert captured.out == ''
+    report = json.loads(captured.err)
+    assert [stage['stage'] for stage in report['stages']] == \
+        ['load_rentals_file']
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+benchmarks for the html rendering classes
+"""
+
+import argparse
+import io
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import html_render as hr
+
+WORKERS = 2
+
+
+def build_list(count):
+    """a Ul with count Li rows, a Br and an Hr every tenth row"""
+    ul = hr.Ul(id="TheList")
+    for i in range(count):
+        ul.append(hr.Li("item {}".format(i)))
+        if i % 10 == 0:
+            ul.append(hr.Br())
+            ul.append(hr.Hr())
+    return ul
+
+
+def bench_memory(count):
+    """bytes per node of a large tree, text included"""
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tree = build_list(count)
+        used = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    nodes = len(tree.content) + 1
+    print("{:<40} {:>10,}".format("nodes", nodes))
+    print("{:<40} {:>10.1f} B".format("memory per node", used / nodes))
+    return tree
+
+
+def timed(label, func, *args):
+    """run func once and print the elapsed wall time"""
+    begin = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - begin
+    print("{:<40} {:>10.3f} s".format(label, elapsed))
+    return result
+
+
+def render_list(ul):
+    """render ul into a string buffer"""
+    out = io.StringIO()
+    ul.render(out)
+    return out.getvalue()
+
+
+def bench_rows(count):
+    """count rows as Li elements against Ul.from_rows"""
+    rows = ["item {} & more".format(i) for i in range(count)]
+
+    def li_list():
+        ul = hr.Ul(id="TheList")
+        for row in rows:
+            ul.append(hr.Li(row))
+        return render_list(ul)
+
+    timed("rows: Li elements", li_list)
+    timed("rows: from_rows, no escaping", lambda: render_list(
+        hr.Ul.from_rows(rows, escape=False, id="TheList")))
+    timed("rows: from_rows, escaped", lambda: render_list(
+        hr.Ul.from_rows(rows, id="TheList")))
+
+
+def build_report(count):
+    """a Body of count sections, each a P and a Ul of two Li"""
+    body = hr.Body()
+    for i in range(count):
+        body.append(hr.P("paragraph {}".format(i), id="p{}".format(i)))
+        ul = hr.Ul(style="line-height:200%")
+        ul.append(hr.Li("item {}".format(i)))
+        ul.append(hr.Li(hr.A("http://google.com", "link"), style="color: red"))
+        body.append(ul)
+        body.append(hr.Hr())
+    return body
+
+
+def render_parallel(body, executor=None):
+    """render_parallel into a string buffer"""
+    out = io.StringIO()
+    body.render_parallel(out, workers=WORKERS, executor=executor)
+    return out.getvalue()
+
+
+def bench_parallel(count):
+    """serial render against render_parallel, with the parent's CPU time
+
+    The pool can only win if the parent spends less CPU time than the
+    serial render; the rest is divided among the workers.
+    """
+    body = build_report(count // 8)
+    timed("parallel: serial render", render_list, body)
+    for label, executor in (("forked pool", None),
+                            ("caller's pool, pickled",
+                             ProcessPoolExecutor(WORKERS))):
+        cpu = time.process_time()
+        timed("parallel: " + label, render_parallel, body, executor)
+        print("{:<40} {:>10.3f} s".format("parallel: parent CPU",
+                                         time.process_time() - cpu))
+        if executor is not None:
+            executor.shutdown()
+
+
+BENCHMARKS = {
+    "memory": bench_memory,
+    "rows": bench_rows,
+    "parallel": bench_parallel,
+}
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="html_render benchmarks")
+    PARSER.add_argument("-n", "--nodes", type=int, default=500000,
+                        help="number of rows. Defaults to 500k")
+    PARSER.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run, from {}. Defaults to all"
+                        .format(", ".join(BENCHMARKS)))
+    ARGS = PARSER.parse_args()
+    for NAME in ARGS.benchmarks:
+        if NAME not in BENCHMARKS:
+            PARSER.error("unknown benchmark {!r}".format(NAME))
+
+    for NAME in ARGS.benchmarks or BENCHMARKS:
+        BENCHMARKS[NAME](ARGS.nodes)
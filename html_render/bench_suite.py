@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+render benchmark suite with a baseline file
+
+Each scenario builds a tree of about n element nodes and reports the
+render time per node, the memory and allocated blocks held per node by
+the tree, and the peak memory per node while rendering it. With
+--check the results are compared to the baseline file and the script
+exits with status 1 if any of them regressed past the tolerance, so it
+can gate CI. --save writes the current results as the new baseline.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import html_render as hr
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "bench_baseline.json")
+SIZES = (10, 100, 1000, 10000, 100000)
+#nesting depth of the deep scenario, its chains repeat to reach n nodes.
+#rendering is iterative, so it is set past the default recursion limit
+DEPTH = 2000
+#seconds each timing run should last, small trees are rendered repeatedly
+MIN_TIME = 0.05
+#allowed growth over the baseline: time is noisy, memory is not
+TOLERANCE = {"ns_per_node": 2.0, "bytes_per_node": 1.1,
+             "blocks_per_node": 1.1, "peak_per_node": 1.25}
+#plus a fixed allowance per tree, which only matters for the small ones
+SLACK = {"ns_per_node": 0, "bytes_per_node": 4096,
+         "blocks_per_node": 32, "peak_per_node": 4096}
+
+
+def build_deep(count):
+    """chains of DEPTH nested P elements, each ending in text"""
+    body = hr.Body()
+    nodes = 1
+    while nodes < count:
+        depth = min(DEPTH, count - nodes)
+        top = node = hr.P()
+        for _ in range(depth - 1):
+            child = hr.P()
+            node.append(child)
+            node = child
+        node.append("leaf at depth {}".format(depth))
+        body.append(top)
+        nodes += depth
+    return body, nodes
+
+
+def build_wide(count):
+    """one Ul with count - 1 Li rows"""
+    ul = hr.Ul(id="TheList")
+    for i in range(count - 1):
+        ul.append(hr.Li("item {}".format(i)))
+    return ul, max(count, 1)
+
+
+def build_attrs(count):
+    """P elements with five attributes each"""
+    body = hr.Body()
+    for i in range(count - 1):
+        body.append(hr.P("paragraph {}".format(i), id="p{}".format(i),
+                         style="text-align: center", title="row",
+                         lang="en", dir="ltr"))
+    return body, max(count, 1)
+
+
+def build_oneline(count):
+    """alternating A and H one line tags"""
+    body = hr.Body()
+    for i in range(count - 1):
+        if i % 2:
+            body.append(hr.A("http://example.com/{}".format(i),
+                             "link {}".format(i)))
+        else:
+            body.append(hr.H(i % 6 + 1, "heading {}".format(i)))
+    return body, max(count, 1)
+
+
+SCENARIOS = {
+    "deep": build_deep,
+    "wide": build_wide,
+    "attrs": build_attrs,
+    "oneline": build_oneline,
+}
+
+
+class NullSink():
+    """a file that throws the output away"""
+
+    def write(self, text):
+        return len(text)
+
+
+def time_render(tree):
+    """best seconds per render over runs of at least MIN_TIME each"""
+    sink = NullSink()
+    number = 1
+    while True:
+        begin = time.perf_counter()
+        for _ in range(number):
+            tree.render(sink)
+        elapsed = time.perf_counter() - begin
+        if elapsed >= MIN_TIME:
+            break
+        number *= 10
+    best = elapsed / number
+    for _ in range(4):
+        begin = time.perf_counter()
+        for _ in range(number):
+            tree.render(sink)
+        best = min(best, (time.perf_counter() - begin) / number)
+    return best
+
+
+def measure(build, count):
+    """the metrics for one scenario at one size"""
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        before = tracemalloc.take_snapshot()
+        tree, nodes = build(count)
+        held = tracemalloc.get_traced_memory()[0] - base
+        blocks = sum(stat.count_diff for stat in
+                     tracemalloc.take_snapshot().compare_to(before,
+                                                            "filename"))
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        tree.render(NullSink())
+        peak = tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    seconds = time_render(tree)
+    return {
+        "nodes": nodes,
+        "ns_per_node": seconds * 1e9 / nodes,
+        "bytes_per_node": held / nodes,
+        "blocks_per_node": blocks / nodes,
+        "peak_per_node": peak / nodes,
+    }
+
+
+def run_suite(names, sizes):
+    """{"scenario/size": metrics} for every scenario and size"""
+    results = {}
+    print("{:<16} {:>9} {:>10} {:>10} {:>10} {:>10}".format(
+        "scenario", "nodes", "ns/node", "B/node", "blocks", "peak B"))
+    for name in names:
+        for size in sizes:
+            metrics = measure(SCENARIOS[name], size)
+            results["{}/{}".format(name, size)] = metrics
+            print("{:<16} {:>9,} {:>10.1f} {:>10.1f} {:>10.2f} {:>10.1f}"
+                  .format(name, metrics["nodes"], metrics["ns_per_node"],
+                          metrics["bytes_per_node"],
+                          metrics["blocks_per_node"],
+                          metrics["peak_per_node"]))
+    return results
+
+
+def compare(results, baseline, scale=1.0):
+    """messages for every metric above its baseline times its tolerance"""
+    regressions = []
+    for key, metrics in results.items():
+        if key not in baseline:
+            continue
+        for metric, tolerance in TOLERANCE.items():
+            old = baseline[key][metric]
+            new = metrics[metric]
+            limit = (old * tolerance + SLACK[metric] / metrics["nodes"]) * \
+                scale
+            if new > limit:
+                regressions.append("{} {}: {:.1f} > {:.1f}".format(
+                    key, metric, new, limit))
+    return regressions
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="html_render benchmark suite")
+    PARSER.add_argument("-s", "--sizes", type=int, nargs="+", default=SIZES,
+                        help="tree sizes in nodes. Defaults to 10 to 100k, "
+                        "add 1000000 for the big runs")
+    PARSER.add_argument("-b", "--baseline", default=BASELINE,
+                        help="baseline file. Defaults to bench_baseline.json")
+    PARSER.add_argument("--save", action="store_true",
+                        help="write the results as the new baseline")
+    PARSER.add_argument("--check", action="store_true",
+                        help="exit with status 1 if a result regressed")
+    PARSER.add_argument("--scale", type=float, default=1.0,
+                        help="multiply all tolerances, e.g. on slow CI hosts")
+    PARSER.add_argument("scenarios", nargs="*",
+                        help="scenarios to run, from {}. Defaults to all"
+                        .format(", ".join(SCENARIOS)))
+    ARGS = PARSER.parse_args()
+    for NAME in ARGS.scenarios:
+        if NAME not in SCENARIOS:
+            PARSER.error("unknown scenario {!r}".format(NAME))
+
+    RESULTS = run_suite(ARGS.scenarios or SCENARIOS, ARGS.sizes)
+    if ARGS.check:
+        with open(ARGS.baseline) as baseline_file:
+            REGRESSIONS = compare(RESULTS, json.load(baseline_file),
+                                  ARGS.scale)
+        for MESSAGE in REGRESSIONS:
+            print("regression:", MESSAGE)
+        if REGRESSIONS:
+            sys.exit(1)
+        print("no regressions against", ARGS.baseline)
+    if ARGS.save:
+        BASELINE_DATA = {}
+        if os.path.exists(ARGS.baseline):
+            with open(ARGS.baseline) as baseline_file:
+                BASELINE_DATA = json.load(baseline_file)
+        BASELINE_DATA.update(RESULTS)
+        with open(ARGS.baseline, "w") as baseline_file:
+            json.dump(BASELINE_DATA, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("saved", ARGS.baseline)
@@ -4,91 +4,659 @@
 A class-based system for rendering html.
 """
 
+import asyncio
+import html
+import multiprocessing
+import os
+import re
+import sys
+import weakref
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from types import MappingProxyType
+
+
+class Text(str):
+    """a text child
+
+    Any str child is rendered as text; Text only makes that explicit.
+    Renderers tell text from elements with an isinstance(str) check.
+    """
+    __slots__ = ()
+
+
+class Slot(str):
+    """placeholder for text that is filled in when a RenderPlan is rendered
+
+    A Slot can be used anywhere a string can: as content or as an
+    attribute value. It renders as a private-use marker that compile()
+    turns into a dynamic slot of the plan.
+    """
+    def __new__(cls, name):
+        slot = super().__new__(cls, "\ue000{}\ue001".format(name))
+        slot.name = name
+        return slot
+
+    def __getnewargs__(self):
+        #pickle rebuilds from the name, not the marker text
+        return (self.name,)
+
+
+_CACHE_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def render_cache_stats():
+    """hits, misses, invalidations and hit rate of memoized elements"""
+    stats = dict(_CACHE_STATS)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_render_cache_stats():
+    """zero the render cache counters"""
+    for key in _CACHE_STATS:
+        _CACHE_STATS[key] = 0
+
+
+# shared by every element created without attributes
+EMPTY_ATTRIBUTES = MappingProxyType({})
+
+
+class Attributes(dict):
+    """element attributes that invalidate the owner's render cache on change"""
+    __slots__ = ("owner",)
+
+    def __init__(self, owner, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner = owner
+
+    def __reduce__(self):
+        return (Attributes, (self.owner, dict(self)))
+
+    def _changed(self):
+        self.owner.invalidate()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._changed()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self._changed()
+        return value
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class Fragments(list):
+    """a file-like sink that keeps every write as a list item
+
+    render() issues many tiny writes; appending them to a list and
+    joining once at the end is cheaper than growing a StringIO.
+    """
+    write = list.append
+
+    def getvalue(self):
+        """all fragments joined"""
+        return "".join(self)
+
+
+def _iter_child(child, cur_ind=""):
+    """chunks of a child element
+
+    Objects that only provide render(out_file, cur_ind) are rendered into
+    a Fragments list first.
+    """
+    try:
+        iter_render = child.iter_render
+    except AttributeError:
+        fragments = Fragments()
+        child.render(fragments, cur_ind)
+        return fragments
+    return iter_render(cur_ind)
+
+
+#child indent strings by (indent, cur_ind), so each level is built once
+_INDENTS = {}
+#the table stops growing here; deeper levels are concatenated each time
+_INDENTS_MAX = 1024
+
+
+def _child_indent(cur_ind, indent):
+    """cur_ind + indent, from the indent table"""
+    table = _INDENTS.get(indent)
+    if table is None:
+        table = _INDENTS[indent] = {}
+    child_ind = table.get(cur_ind)
+    if child_ind is None:
+        child_ind = cur_ind + indent
+        if len(table) < _INDENTS_MAX:
+            table[cur_ind] = child_ind
+    return child_ind
+
+
+def _walk(chunks):
+    """drive _iter_chunks generators with an explicit stack
+
+    _iter_chunks yields output strings, and (child, cur_ind) tuples for
+    child content to render in place. Each child gets a frame on the
+    stack instead of a nested generator, so the depth of the tree is not
+    limited by the recursion limit. Memoized children are served from or
+    added to their cache; a miss collects the child's output while it is
+    passed on.
+    """
+    stack = [(chunks, None)]
+    #output lists of the memoized children being rendered, innermost last
+    collecting = []
+    while stack:
+        chunks, memo = stack[-1]
+        for chunk in chunks:
+            if type(chunk) is tuple:
+                child, cur_ind = chunk
+                if isinstance(child, Element):
+                    cache = child._render_cache
+                    if cache is None:
+                        stack.append((child._iter_chunks(cur_ind), None))
+                        break
+                    chunk = cache.get(cur_ind)
+                    if chunk is None:
+                        parts = []
+                        collecting.append(parts)
+                        stack.append((child._iter_chunks(cur_ind),
+                                      (cache, cur_ind, parts)))
+                        break
+                    _CACHE_STATS["hits"] += 1
+                else:
+                    stack.append((iter(_iter_child(child, cur_ind)), None))
+                    break
+            if collecting:
+                for parts in collecting:
+                    parts.append(chunk)
+            yield chunk
+        else:
+            stack.pop()
+            if memo is not None:
+                cache, cur_ind, parts = memo
+                collecting.pop()
+                cache[cur_ind] = "".join(parts)
+                _CACHE_STATS["misses"] += 1
+
+
+def _render_contents(contents, cur_ind):
+    """worker body for render_parallel: a run of content items as a string"""
+    parts = []
+    for content in contents:
+        if isinstance(content, str):
+            parts.append(cur_ind + content + "\n")
+        else:
+            parts.extend(_iter_child(content, cur_ind))
+    return "".join(parts)
+
+
+#the content of the render_parallel call in progress, inherited by forked
+#workers so the subtrees are not pickled
+_SHARED_CONTENTS = None
+
+
+def _render_shared_contents(start, stop, cur_ind):
+    """worker body for forked workers: a run of _SHARED_CONTENTS"""
+    return _render_contents(_SHARED_CONTENTS[start:stop], cur_ind)
+
+
+#pickled slot names per element class, all but the parent links
+_STATE_SLOTS = {}
+
+
+def _state_slots(cls):
+    """the names of the slots __getstate__ saves for cls, in MRO order"""
+    names = _STATE_SLOTS.get(cls)
+    if names is None:
+        names = _STATE_SLOTS[cls] = tuple(
+            name for klass in reversed(cls.__mro__)
+            for name in getattr(klass, "__slots__", ())
+            if name not in ("_parents", "__weakref__"))
+    return names
+
+
+def _free_threaded():
+    """True on a Python build running without the GIL"""
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def _forks():
+    """True when new processes are started with fork
+
+    The configured start method is read without fixing it, falling back
+    to the platform default when none has been set yet.
+    """
+    method = (multiprocessing.get_start_method(allow_none=True) or
+              multiprocessing.get_all_start_methods()[0])
+    return method == "fork"
+
+
+class RenderPlan():
+    """a compiled element tree: static fragments with named slots between"""
+    SLOT_MARKER = re.compile("\ue000(.*?)\ue001", re.S)
+
+    def __init__(self, rendered):
+        #even positions are static text, odd positions are slot names
+        parts = self.SLOT_MARKER.split(rendered)
+        self.fragments = parts[:]
+        self.slots = [(i, parts[i]) for i in range(1, len(parts), 2)]
+
+    def render_to_string(self, **values):
+        """fill every slot from values and join in one go"""
+        if not self.slots:
+            return self.fragments[0]
+        parts = self.fragments[:]
+        for i, name in self.slots:
+            parts[i] = values[name]
+        return "".join(parts)
+
+    def render(self, out_file, **values):
+        """write the filled plan with a single write call"""
+        out_file.write(self.render_to_string(**values))
+
 
 # This is the framework for the base class
 class Element():
     """"This is most basic element class in html render, other classes will be built based on it"""
     tag_name = "html"
     indent = "    "
+    __slots__ = ("content", "_kwargs", "_parents", "_render_cache",
+                 "__weakref__")
 
     def __init__(self, content=None, **kwargs):
+        #a new element has no memoized ancestor, so nothing to link yet
+        self._parents = None
+        self._render_cache = None
         self.content = [] if content is None else [content]
-        self.kwargs = kwargs
+        self._kwargs = Attributes(self, kwargs) if kwargs else \
+            EMPTY_ATTRIBUTES
+
+    @property
+    def kwargs(self):
+        """the tag attributes; changing them invalidates the render cache"""
+        if self._kwargs is EMPTY_ATTRIBUTES:
+            self._kwargs = Attributes(self)
+        return self._kwargs
+
+    @kwargs.setter
+    def kwargs(self, kwargs):
+        self._kwargs = Attributes(self, kwargs) if kwargs else EMPTY_ATTRIBUTES
+        self.invalidate()
 
     def append(self, new_content):
-        """add new content between tags"""
+        """add new content between tags
+
+        new_content may also be an iterator, e.g. a generator of Li
+        elements; it is consumed lazily each time the element is
+        rendered, so it only renders once.
+        """
         self.content.append(new_content)
+        if self._render_cache is not None or self._parents is not None:
+            if self._adopt(new_content):
+                new_content._track()
+            self.invalidate()
+
+    def _adopt(self, child):
+        """link a child element back to this one for cache invalidation
+
+        Links are only kept below memoized elements, where invalidate()
+        needs them, and are weak so a shared child does not keep its
+        parents alive. Returns True if child had no links of its own
+        yet, i.e. its subtree still has to be linked with _track().
+        """
+        #a single parent is stored as is, a list only once shared
+        if not isinstance(child, Element):
+            return False
+        parent = weakref.ref(self)
+        parents = child._parents
+        if parents is None:
+            child._parents = parent
+            return child._render_cache is None
+        if isinstance(parents, list):
+            parents.append(parent)
+        else:
+            child._parents = [parents, parent]
+        return False
+
+    def _track(self):
+        """link every element in this subtree to its parents"""
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            for content in element.content:
+                if element._adopt(content):
+                    stack.append(content)
+
+    def __getstate__(self):
+        """pickle without the parent links, which would pull in the whole tree"""
+        values = [getattr(self, name) for name in _state_slots(type(self))]
+        #the shared empty mapping cannot be pickled
+        if values[1] is EMPTY_ATTRIBUTES:
+            values[1] = None
+        return values, getattr(self, "__dict__", None)
+
+    def __setstate__(self, state):
+        values, attributes = state
+        self._parents = None
+        for name, value in zip(_state_slots(type(self)), values):
+            setattr(self, name, value)
+        if self._kwargs is None:
+            self._kwargs = EMPTY_ATTRIBUTES
+        if attributes:
+            self.__dict__.update(attributes)
+        if self._render_cache is not None:
+            self._track()
+
+    def memoize(self):
+        """cache this element's rendered output per indent level
+
+        An unchanged subtree then renders as a single string. The cache
+        is dropped when append() or an attribute change touches the
+        subtree; call invalidate() after changing content some other
+        way, e.g. mutating self.content directly. Returns self.
+        """
+        if self._render_cache is None:
+            tracked = self._parents is not None
+            self._render_cache = {}
+            if not tracked:
+                self._track()
+        return self
+
+    def invalidate(self):
+        """drop the cached output of this element and all its ancestors"""
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            if element._render_cache:
+                element._render_cache.clear()
+                _CACHE_STATS["invalidations"] += 1
+            parents = element._parents
+            if isinstance(parents, list):
+                live = []
+                for parent in parents:
+                    parent_element = parent()
+                    if parent_element is not None:
+                        live.append(parent)
+                        stack.append(parent_element)
+                #forget parents that were garbage collected
+                if len(live) < len(parents):
+                    parents[:] = live
+            elif parents is not None:
+                parent_element = parents()
+                if parent_element is not None:
+                    stack.append(parent_element)
+
+    def iter_content(self):
+        """the content items, with iterator items expanded lazily"""
+        for content in self.content:
+            #text and elements first, the Iterator ABC check is slow
+            if type(content) is str or isinstance(content, Element) or \
+                    not isinstance(content, Iterator):
+                yield content
+            else:
+                yield from content
+
+    def compile(self, cur_ind=""):
+        """flatten this tree into a RenderPlan
+
+        Rendering the plan gives the same output as render(out_file,
+        cur_ind), with any Slot filled in from the values passed to it.
+        The plan does not follow later changes to the tree.
+        """
+        return RenderPlan(self.render_to_string(cur_ind))
+
+    def render_to_string(self, cur_ind=""):
+        """render and join all chunks once"""
+        return "".join(self.iter_render(cur_ind))
+
+    def iter_render(self, cur_ind=""):
+        """iterate over the rendered element in chunks, one line at a time
+
+        Large pages can be streamed to a file or socket without holding
+        the whole output in memory. A memoized element yields its cached
+        output as one chunk.
+        """
+        cache = self._render_cache
+        if cache is None:
+            return _walk(self._iter_chunks(cur_ind))
+        try:
+            text = cache[cur_ind]
+            _CACHE_STATS["hits"] += 1
+        except KeyError:
+            text = cache[cur_ind] = "".join(_walk(self._iter_chunks(cur_ind)))
+            _CACHE_STATS["misses"] += 1
+        return iter((text,))
+
+    def render_bytes(self, cur_ind="", encoding="utf-8"):
+        """the rendered page, encoded"""
+        return self.render_to_string(cur_ind).encode(encoding)
+
+    def render_binary(self, out_file, cur_ind="", encoding="utf-8"):
+        """write the encoded page to a binary file with one write call"""
+        out_file.write(self.render_bytes(cur_ind, encoding))
 
     def render(self, out_file, cur_ind=""):
         """render functions"""
+        write = out_file.write
+        for chunk in self.iter_render(cur_ind):
+            write(chunk)
+
+    async def aiter_render(self, cur_ind="", yield_every=100):
+        """async iterator over the same chunks as iter_render
+
+        Control goes back to the event loop every yield_every chunks
+        (about one chunk per node), so rendering a big page does not
+        block other tasks.
+        """
+        count = 0
+        for chunk in self.iter_render(cur_ind):
+            yield chunk
+            count += 1
+            if count == yield_every:
+                count = 0
+                await asyncio.sleep(0)
+
+    async def render_async(self, writer, cur_ind="", encoding="utf-8",
+                           yield_every=100, buffer_size=65536):
+        """render to an asyncio.StreamWriter or any other async sink
+
+        Chunks are batched up to buffer_size characters. A writer with
+        drain() (StreamWriter) gets write(data) followed by
+        await drain(), which applies the transport's backpressure; any
+        other writer must have an async write(data). Data is encoded
+        with encoding, or passed as str when encoding is None.
+        """
+        drain = getattr(writer, "drain", None)
+
+        async def flush(parts):
+            data = "".join(parts)
+            if encoding is not None:
+                data = data.encode(encoding)
+            if drain is not None:
+                writer.write(data)
+                await drain()
+            else:
+                await writer.write(data)
+
+        parts = []
+        size = 0
+        async for chunk in self.aiter_render(cur_ind, yield_every):
+            parts.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                await flush(parts)
+                parts = []
+                size = 0
+        if parts:
+            await flush(parts)
+
+    def render_parallel(self, out_file, cur_ind="", workers=None,
+                        executor=None):
+        """render with the child subtrees rendered concurrently
+
+        The content is split into a few contiguous runs per worker, each
+        rendered on its own at the indent render() would give it, in a
+        process pool (or a thread pool on a free-threaded Python), and
+        the results are written back in order. Where the start method
+        is fork, the workers inherit the tree and only the bounds of each
+        run are sent to them. Pass executor to reuse a pool across calls;
+        the content then has to be pickled for a process pool. Otherwise
+        one is created with workers workers and shut down again. Elements
+        whose render is not the plain Element layout are rendered
+        serially.
+        """
+        global _SHARED_CONTENTS
+        cache = self._render_cache
+        if (type(self)._iter_chunks is not Element._iter_chunks or
+                (cache and cur_ind in cache)):
+            self.render(out_file, cur_ind)
+            return
+
+        child_ind = _child_indent(cur_ind, self.indent)
+        contents = list(self.iter_content())
+        forked = False
+        own_executor = executor is None
+        if own_executor:
+            if _free_threaded():
+                executor = ThreadPoolExecutor(max_workers=workers)
+            else:
+                forked = _forks()
+                executor = ProcessPoolExecutor(max_workers=workers)
+        count = workers or os.cpu_count() or 1
+        size = max(1, -(-len(contents) // (4 * count)))
+        starts = range(0, len(contents), size)
+        try:
+            if forked:
+                #set before map() starts the workers, so they inherit it
+                _SHARED_CONTENTS = contents
+                rendered = executor.map(
+                    _render_shared_contents, starts,
+                    [start + size for start in starts], repeat(child_ind))
+            else:
+                rendered = executor.map(
+                    _render_contents,
+                    [contents[start:start + size] for start in starts],
+                    repeat(child_ind))
+            write = out_file.write
+            write(self._open_tag(cur_ind))
+            for text in rendered:
+                write(text)
+            write(self._close_tag(cur_ind))
+        finally:
+            _SHARED_CONTENTS = None
+            if own_executor:
+                executor.shutdown()
+
+    def _open_tag(self, cur_ind):
+        """the doctype, if any, and the opening tag line"""
+        open_tag = []
         if self.tag_name == "html":
-            out_file.write(cur_ind)
-            out_file.write("<!DOCTYPE html>\n")
-
+            open_tag.append(cur_ind + "<!DOCTYPE html>\n")
+        open_tag += [cur_ind, "<", self.tag_name]
+        if self._kwargs:
+            for x in self._kwargs:
+                open_tag.append(' {}="{}"'.format(x, self._kwargs[x]))
+        open_tag.append(">\n")
+        return "".join(open_tag)
+
+    def _close_tag(self, cur_ind):
+        """the closing tag line"""
+        return "{}</{}>\n".format(cur_ind, self.tag_name)
+
+    def _iter_chunks(self, cur_ind=""):
+        """generate the rendered chunks; subclasses override this
+
+        Child content is yielded as a (child, cur_ind) tuple and rendered
+        in its place by iter_render, which keeps the walk non-recursive.
+        """
         #open tag
-        if cur_ind:
-            out_file.write(cur_ind)
-        if self.kwargs is not None:
-            open_tag = ["<{}".format(self.tag_name)]
-            for x in self.kwargs:
-                open_tag.append(" ")
-                open_tag.append(x)
-                open_tag.append("=")
-                open_tag.append('"{}"'.format(self.kwargs[x]))
-            open_tag.append(">\n")
-            out_file.write("".join(open_tag))
-        else:
-            out_file.write("<{}>".format(self.tag_name))
-            out_file.write("\n")
+        yield self._open_tag(cur_ind)
 
         #content
-        for content in self.content:
-            try:
-                content.render(out_file, cur_ind+self.indent)
-            except AttributeError:
-                if cur_ind:
-                    out_file.write(cur_ind)
-                out_file.write(self.indent)
-                out_file.write(content)
-                out_file.write("\n")
+        child_ind = _child_indent(cur_ind, self.indent)
+        for content in self.iter_content():
+            if isinstance(content, str):
+                yield child_ind + content + "\n"
+            else:
+                yield content, child_ind
 
         #end tag
-        if cur_ind:
-            out_file.write(cur_ind)
-        out_file.write("</{}>\n".format(self.tag_name))
+        yield self._close_tag(cur_ind)
 
 
 #a subclass of Element with tag body
 class Body(Element):
     """body tag"""
     tag_name = "body"
+    __slots__ = ()
 
 #subclass for paragraph
 class P(Element):
     """paragraph"""
     tag_name = "p"
+    __slots__ = ()
 
 class Html(Element):
     """html tag"""
     tag_name = "html"
+    __slots__ = ()
 
 class Head(Element):
     """head tag"""
     tag_name = "head"
+    __slots__ = ()
 
 
 class OneLineTag(Element):
     """class for one line with tags"""
-    def render(self, out_file, cur_ind=""):
-        if cur_ind:
-            out_file.write(cur_ind)
-        for content in self.content:
-            out_file.write("<{}> ".format(self.tag_name))
-            try:
-                content.render(out_file)
-            except AttributeError:
-                out_file.write(content)
-            out_file.write(" </{}>\n".format(self.tag_name))
+    __slots__ = ()
+
+    def _iter_chunks(self, cur_ind=""):
+        #the line is one chunk, split only around child elements
+        open_tag = "<{}> ".format(self.tag_name)
+        close_tag = " </{}>\n".format(self.tag_name)
+        line = [cur_ind]
+        for content in self.iter_content():
+            line.append(open_tag)
+            if isinstance(content, str):
+                line.append(content)
+            else:
+                yield "".join(line)
+                yield content, ""
+                line = []
+            line.append(close_tag)
+        if line:
+            yield "".join(line)
 
     #change the test file with import pytest
     def append(self, content):
@@ -97,70 +665,79 @@ class OneLineTag(Element):
 class Title(OneLineTag):
     """Title class, one line"""
     tag_name = "title"
+    __slots__ = ()
 
 class SelfClosingTag(Element):
     """"self closing tag"""
+    __slots__ = ()
+
     def __init__(self, content=None, **kwargs):
         if content is not None:
             raise TypeError("SelfClosingTag can not contain any content")
         super().__init__(content=content, **kwargs)
+        self.content = ()
 
     def append(self):
         raise TypeError("You can not add content to a SelfClosingTag")
 
     #somethinkg like <hr width="400" />
-    def render(self, out_file, cur_ind=""):
-        if cur_ind:
-            out_file.write(cur_ind)
+    def _iter_chunks(self, cur_ind=""):
+        line = [cur_ind]
         open_tag = ["<{} ".format(self.tag_name)]
-        if self.kwargs:
-            for x in self.kwargs:
+        if self._kwargs:
+            for x in self._kwargs:
                 open_tag.append(x)
                 open_tag.append("=")
-                open_tag.append('"{}"'.format(self.kwargs[x]))
-                out_file.write("".join(open_tag))
-                out_file.write(" ")
+                open_tag.append('"{}"'.format(self._kwargs[x]))
+                line.append("".join(open_tag))
+                line.append(" ")
         else:
-            out_file.write("".join(open_tag))
+            line.append("".join(open_tag))
 
-        out_file.write("/>\n")
+        line.append("/>\n")
+        yield "".join(line)
 
 class Hr(SelfClosingTag):
     """Hr tag class, self closing tag"""
     tag_name = "hr"
+    __slots__ = ()
 
 class Br(SelfClosingTag):
     """Br tag, self closing tag"""
     tag_name = "br"
+    __slots__ = ()
 
 #should look like this <a href="http://google.com">link to google</a>
 class A(OneLineTag):
     """anchor tag, one line tag"""
     tag_name = "a"
+    __slots__ = ()
 
     def __init__(self, link, content, **kwargs):
         kwargs['href'] = link
         self.content = content
         super().__init__(content, **kwargs)
 
-    def render(self, out_file, cur_ind=""):
-        if cur_ind:
-            out_file.write(cur_ind)
+    def _iter_chunks(self, cur_ind=""):
+        line = [cur_ind]
         open_tag = ["<{} ".format(self.tag_name)]
-        if self.kwargs:
-            for x in self.kwargs:
+        if self._kwargs:
+            for x in self._kwargs:
                 open_tag.append(x)
                 open_tag.append("=")
-                open_tag.append('"{}"'.format(self.kwargs[x]))
+                open_tag.append('"{}"'.format(self._kwargs[x]))
                 open_tag.append(">{}".format(self.content[0]))
-                out_file.write("".join(open_tag))
+                line.append("".join(open_tag))
         else:
-            out_file.write("".join(open_tag))
+            line.append("".join(open_tag))
 
-        out_file.write("</{}>".format(self.tag_name))
+        line.append("</{}>".format(self.tag_name))
+        yield "".join(line)
 
 class H(OneLineTag):
     """head, one line tag"""
+    __slots__ = ("tag_name",)
+
     def __init__(self, level, content=None, **kwargs):
         self.tag_name = "h{}".format(level)
         self.content = [content]
@@ -169,36 +746,111 @@ class H(OneLineTag):
 class Li(OneLineTag):
     """list tag, one line tag"""
     tag_name = "li"
+    __slots__ = ()
 
-    def render(self, out_file, cur_ind=""):
-        if cur_ind:
-            out_file.write(cur_ind)
+    def _iter_chunks(self, cur_ind=""):
+        #the line is one chunk, split only around child elements
+        line = [cur_ind]
         open_tag = ["<{} ".format(self.tag_name)]
-        if self.kwargs:
-            for x in self.kwargs:
+        if self._kwargs:
+            for x in self._kwargs:
                 open_tag.append(x)
                 open_tag.append("=")
-                open_tag.append('"{}">'.format(self.kwargs[x]))
-                out_file.write("".join(open_tag))
+                open_tag.append('"{}">'.format(self._kwargs[x]))
+                line.append("".join(open_tag))
         else:
             open_tag.append(">")
-            out_file.write("".join(open_tag))
+            line.append("".join(open_tag))
 
-        for content in self.content:
-            try:
-                content.render(out_file)
-            except AttributeError:
-                out_file.write(content)
+        for content in self.iter_content():
+            if isinstance(content, str):
+                line.append(content)
+            else:
+                yield "".join(line)
+                yield content, ""
+                line = []
 
-        out_file.write("</{}>\n".format(self.tag_name))
+        line.append("</{}>\n".format(self.tag_name))
+        yield "".join(line)
 
     def append(self, new_content):
-        self.content.append(new_content)
+        Element.append(self, new_content)
 
 class Ul(Element):
     """Ul tag, normal element"""
     tag_name = "ul"
+    __slots__ = ()
+
+    @classmethod
+    def from_rows(cls, rows, attrs=None, escape=True, **kwargs):
+        """a Ul with one Li per string in rows, rendered in bulk
+
+        attrs are the attributes of every Li; kwargs those of the Ul.
+        Row text and attribute values are HTML-escaped unless escape is
+        False. See Rows.
+        """
+        ul = cls(**kwargs)
+        ul.append(Rows(rows, Li, attrs, escape))
+        return ul
 
 class Meta(SelfClosingTag):
     """Meta tag, self closing tag """
     tag_name = "meta"
+    __slots__ = ()
+
+
+class Rows():
+    """a batch of identical one-line elements that differ only in text
+
+    The row layout comes from rendering one row_class element with a Slot
+    for its text, so each row matches row_class(text, **attrs) exactly.
+    All rows are then escaped and joined in a few whole-batch string
+    operations instead of one element per row.
+    """
+    __slots__ = ("rows", "row_class", "attrs", "escape")
+
+    #joins the rows while escaping; rows containing it are done one by one
+    SEPARATOR = "\x00"
+
+    def __init__(self, rows, row_class=None, attrs=None, escape=True):
+        self.rows = [row if isinstance(row, str) else str(row)
+                     for row in rows]
+        self.row_class = Li if row_class is None else row_class
+        self.attrs = dict(attrs or {})
+        self.escape = escape
+
+    def template(self, cur_ind=""):
+        """(prefix, suffix) that surround each row's text"""
+        attrs = self.attrs
+        if self.escape:
+            attrs = {key: html.escape(str(value))
+                     for key, value in attrs.items()}
+        plan = self.row_class(Slot("text"), **attrs).compile(cur_ind)
+        if len(plan.slots) != 1:
+            raise ValueError("{} does not render its text exactly once"
+                             .format(self.row_class.__name__))
+        prefix, _, suffix = plan.fragments
+        return prefix, suffix
+
+    def render_to_string(self, cur_ind=""):
+        """every row rendered, with one join for the whole batch"""
+        if not self.rows:
+            return ""
+        prefix, suffix = self.template(cur_ind)
+        rows = self.rows
+        if self.escape:
+            text = self.SEPARATOR.join(rows)
+            if text.count(self.SEPARATOR) == len(rows) - 1:
+                text = html.escape(text, quote=False)
+                return prefix + text.replace(self.SEPARATOR,
+                                             suffix + prefix) + suffix
+            rows = [html.escape(row, quote=False) for row in rows]
+        return prefix + (suffix + prefix).join(rows) + suffix
+
+    def iter_render(self, cur_ind=""):
+        """the rendered batch as a single chunk"""
+        return iter((self.render_to_string(cur_ind),))
+
+    def render(self, out_file, cur_ind=""):
+        """write the rendered batch with one write call"""
+        out_file.write(self.render_to_string(cur_ind))
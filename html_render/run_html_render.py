@@ -5,25 +5,21 @@ a simple script can run and test the html rendering classes.
 
 """
 
-from io import StringIO
+import sys
 import html_render as hr
 
 
 # writing the file out:
 def render_page(page, filename, indent=None):
     """
-    render the tree of elements
+    render the tree of elements, streaming it to stdout and the file
     """
 
-    f = StringIO()
-    if indent is None:
-        page.render(f)
-    else:
-        page.render(f, indent)
-
-    print(f.getvalue())
-    with open(filename, 'w') as outfile:
-        outfile.write(f.getvalue())
+    with open(filename, 'wb') as outfile:
+        for chunk in page.iter_render("" if indent is None else indent):
+            sys.stdout.write(chunk)
+            outfile.write(chunk.encode("utf-8"))
+    print()
 
 
 # Step 1
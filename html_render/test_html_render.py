@@ -4,6 +4,7 @@ test code for html_render.py
 """
 
 import io
+import sys
 import pytest
 
 # import * is often bad form, but makes it easier to test everything in a module.
@@ -328,3 +329,437 @@ def test_element_indent1():
     assert lines[2].startswith(Element.indent + "thi")
     assert lines[3] == "</html>"
     assert file_contents.endswith("</html>")
+
+
+# compiled render plans
+
+def test_compile_matches_render():
+    """a plan without slots renders exactly like the tree"""
+    page = Html()
+    head = Head()
+    head.append(Meta(charset="UTF-8"))
+    head.append(Title("a title"))
+    page.append(head)
+    body = Body()
+    body.append(P("some text", style="color: red"))
+    body.append(Hr())
+    body.append(A("http://google.com", "link"))
+    ul = Ul(id="TheList")
+    ul.append(Li("an item", style="color: red"))
+    body.append(ul)
+    page.append(body)
+
+    plan = page.compile()
+    assert plan.render_to_string() == render_result(page)
+    assert page.compile("  ").render_to_string() == render_result(page, "  ")
+
+
+def test_compile_slots():
+    """slots are filled in at render time, in content and attributes"""
+    page = Body()
+    page.append(P(Slot("text"), style=Slot("style")))
+    page.append(Li(Slot("item")))
+    plan = page.compile()
+
+    expected = Body()
+    expected.append(P("hello", style="color: red"))
+    expected.append(Li("first"))
+
+    outfile = io.StringIO()
+    plan.render(outfile, text="hello", style="color: red", item="first")
+    assert outfile.getvalue() == render_result(expected)
+    with pytest.raises(KeyError):
+        plan.render_to_string(text="hello")
+
+
+def test_slot_pickle():
+    """a pickled Slot comes back with the same name and marker"""
+    import pickle
+    slot = pickle.loads(pickle.dumps(Slot("text")))
+    assert slot.name == "text"
+    assert slot == Slot("text")
+
+
+# string and bytes rendering
+
+def test_render_to_string():
+    """render_to_string gives the same text as render into a StringIO"""
+    page = Html(Body(P("some text", id="intro")))
+    page.append(Ul(Li("an item")))
+    assert page.render_to_string() == render_result(page)
+    assert page.render_to_string("  ") == render_result(page, "  ")
+
+
+def test_render_bytes():
+    """render_bytes and render_binary write the encoded page"""
+    page = Html(P("café"))
+    assert page.render_bytes() == render_result(page).encode("utf-8")
+
+    outfile = io.BytesIO()
+    page.render_binary(outfile, encoding="latin-1")
+    assert outfile.getvalue() == render_result(page).encode("latin-1")
+
+
+# streaming render
+
+def test_iter_render():
+    """the chunks from iter_render join up to the rendered page"""
+    page = Html(Head(Title("a title")))
+    body = Body(P("some text"))
+    body.append(Hr())
+    body.append(A("http://google.com", "link"))
+    page.append(body)
+    chunks = list(page.iter_render())
+    assert len(chunks) > 1
+    assert "".join(chunks) == render_result(page)
+
+
+def test_generator_children():
+    """children from a generator are only consumed during rendering"""
+    consumed = []
+
+    def items():
+        for i in range(3):
+            consumed.append(i)
+            yield Li("item {}".format(i))
+
+    ul = Ul()
+    ul.append(items())
+    assert consumed == []
+
+    chunks = ul.iter_render()
+    next(chunks)
+    assert consumed == []
+
+    expected = Ul()
+    for i in range(3):
+        expected.append(Li("item {}".format(i)))
+    assert "<ul>\n" + "".join(chunks) == render_result(expected)
+    assert consumed == [0, 1, 2]
+
+
+# subtree render cache
+
+def test_memoize_hits():
+    """an unchanged memoized subtree renders from the cache"""
+    reset_render_cache_stats()
+    head = Head()
+    head.append(Meta(charset="UTF-8"))
+    head.append(Title("a title"))
+    head.memoize()
+    page = Html(head)
+    page.append(Body(P("some text")))
+
+    first = render_result(page)
+    second = render_result(page)
+    assert first == second
+    chunks = list(head.iter_render(Element.indent))
+    assert len(chunks) == 1
+    assert chunks[0] in first
+    stats = render_cache_stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+    assert stats["hit_rate"] == 2 / 3
+
+
+def test_memoize_invalidation():
+    """append and attribute changes below a memoized element drop its cache"""
+    ul = Ul(Li("first"))
+    body = Body(ul).memoize()
+    before = render_result(body)
+
+    ul.append(Li("second"))
+    after_append = render_result(body)
+    assert "second" in after_append
+    assert after_append != before
+
+    ul.kwargs["id"] = "TheList"
+    after_attr = render_result(body)
+    assert 'id="TheList"' in after_attr
+
+    uncached = Body(Ul(Li("first"), id="TheList"))
+    uncached.content[0].append(Li("second"))
+    assert after_attr == render_result(uncached)
+
+
+def test_memoize_links_are_weak():
+    """a shared memoized child neither keeps its pages alive nor slows down"""
+    import gc
+    head = Head(Title("shared")).memoize()
+    pages = [Html(head) for _ in range(100)]
+    for page in pages:
+        page.append(head)
+    assert head._parents is None
+
+    memoized = [Html(head).memoize() for _ in range(100)]
+    assert len(head._parents) == 100
+    before = render_result(memoized[0])
+    del memoized[1:]
+    gc.collect()
+    head.append(Meta(charset="UTF-8"))
+    assert len(head._parents) == 1
+    expected = Head(Title("shared"))
+    expected.append(Meta(charset="UTF-8"))
+    assert render_result(memoized[0]) != before
+    assert render_result(memoized[0]) == render_result(Html(expected))
+
+
+def test_memoize_after_build():
+    """memoize() links a subtree built before it, deep ones included"""
+    top = node = Body()
+    for _ in range(sys.getrecursionlimit() + 10):
+        child = P()
+        node.append(child)
+        node = child
+    top.memoize()
+    before = render_result(top)
+    node.append("new text")
+    after = render_result(top)
+    assert after != before
+    assert "new text" in after
+
+
+# compact nodes
+
+def test_compact_nodes():
+    """elements use __slots__ and share one empty attribute mapping"""
+    li = Li("an item")
+    br = Br()
+    assert not hasattr(li, "__dict__")
+    assert not hasattr(br, "__dict__")
+    assert li._kwargs is br._kwargs is EMPTY_ATTRIBUTES
+
+    li.kwargs["style"] = "color: red"
+    assert br._kwargs is EMPTY_ATTRIBUTES
+    assert render_result(li) == '<li style="color: red">an item</li>\n'
+
+
+def test_text_node():
+    """Text children render like plain strings"""
+    p = P(Text("some text"))
+    p.append("more text")
+    assert render_result(p) == "<p>\n    some text\n    more text\n</p>\n"
+
+
+# parallel rendering
+
+def build_report(rows=50):
+    """a body of independent sections for the parallel tests"""
+    body = Body()
+    for i in range(rows):
+        body.append(P("paragraph {}".format(i), id="p{}".format(i)))
+        ul = Ul(style="line-height:200%")
+        ul.append(Li("item {}".format(i)))
+        ul.append(Li(A("http://google.com", "link"), style="color: red"))
+        body.append(ul)
+        body.append("plain text {}".format(i))
+        body.append(Hr())
+    return Html(body)
+
+
+def test_pickle_subtree():
+    """a pickled child does not drag its parents along"""
+    import pickle
+    page = build_report(2)
+    ul = page.content[0].content[1]
+    copy = pickle.loads(pickle.dumps(ul))
+    assert copy._parents is None
+    assert copy.content[0]._parents is None
+    assert render_result(copy) == render_result(ul)
+
+    copy = pickle.loads(pickle.dumps(ul.memoize()))
+    assert copy._parents is None
+    assert copy.content[0]._parents() is copy
+    assert render_result(copy) == render_result(ul)
+
+
+
+class Section(Body):
+    """a subclass without __slots__, so with a __dict__"""
+
+
+def test_pickle_state():
+    """subclass slots, attributes and instance dicts survive pickling"""
+    import pickle
+    section = Section(H(2, "a heading"), id="s1")
+    section.note = "kept"
+    section.append(P("text", style="color: red"))
+    section.append(Br())
+    copy = pickle.loads(pickle.dumps(section))
+    assert copy.note == "kept"
+    assert copy.content[0].tag_name == "h2"
+    assert copy.content[2]._kwargs is EMPTY_ATTRIBUTES
+    assert render_result(copy) == render_result(section)
+
+def test_render_parallel_processes():
+    """process pool output matches render, indentation included"""
+    page = build_report()
+    outfile = io.StringIO()
+    page.content[0].render_parallel(outfile, "  ", workers=2)
+    assert outfile.getvalue() == render_result(page.content[0], "  ")
+
+    outfile = io.StringIO()
+    page.render_parallel(outfile, workers=2)
+    assert outfile.getvalue() == render_result(page)
+
+
+def test_render_parallel_start_method(monkeypatch):
+    """the tree is only inherited when the start method is fork"""
+    import html_render
+    import multiprocessing
+    monkeypatch.setattr(multiprocessing, "get_start_method",
+                        lambda allow_none=False: "spawn")
+    assert not html_render._forks()
+    monkeypatch.setattr(multiprocessing, "get_start_method",
+                        lambda allow_none=False: "fork")
+    assert html_render._forks()
+
+    #the pickling path gives the same page
+    monkeypatch.setattr(html_render, "_forks", lambda: False)
+    page = build_report()
+    outfile = io.StringIO()
+    page.render_parallel(outfile, workers=2)
+    assert outfile.getvalue() == render_result(page)
+
+
+def test_render_parallel_threads():
+    """a caller supplied executor is used and left running"""
+    from concurrent.futures import ThreadPoolExecutor
+    page = build_report()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        outfile = io.StringIO()
+        page.content[0].render_parallel(outfile, executor=executor)
+        assert outfile.getvalue() == render_result(page.content[0])
+        li = Li("one line")
+        outfile = io.StringIO()
+        li.render_parallel(outfile, executor=executor)
+        assert outfile.getvalue() == render_result(li)
+
+
+# asyncio rendering
+
+class StreamSink:
+    """StreamWriter stand-in: sync write, async drain"""
+    def __init__(self):
+        self.data = []
+        self.drains = 0
+
+    def write(self, data):
+        self.data.append(data)
+
+    async def drain(self):
+        self.drains += 1
+
+
+class AsyncSink:
+    """a sink with an async write"""
+    def __init__(self):
+        self.data = []
+
+    async def write(self, data):
+        self.data.append(data)
+
+
+def test_render_async_stream_writer():
+    """bytes written to a StreamWriter-like sink match render"""
+    import asyncio
+    page = build_report()
+    sink = StreamSink()
+    asyncio.run(page.render_async(sink, buffer_size=512))
+    assert b"".join(sink.data) == render_result(page).encode("utf-8")
+    assert sink.drains == len(sink.data) > 1
+
+
+def test_render_async_sink():
+    """an async write sink gets str chunks when encoding is None"""
+    import asyncio
+    page = build_report()
+    sink = AsyncSink()
+    asyncio.run(page.render_async(sink, "  ", encoding=None))
+    assert "".join(sink.data) == render_result(page, "  ")
+
+
+def test_aiter_render_yields_to_loop():
+    """other tasks get to run while a page renders"""
+    import asyncio
+    page = build_report()
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0)
+
+    async def main():
+        task = asyncio.ensure_future(ticker())
+        chunks = [chunk async for chunk in page.aiter_render(yield_every=10)]
+        task.cancel()
+        return chunks
+
+    chunks = asyncio.run(main())
+    assert "".join(chunks) == render_result(page)
+    assert len(ticks) > 1
+
+
+# bulk rows
+
+def test_from_rows_matches_li():
+    """from_rows renders like a Ul of Li elements"""
+    rows = ["item {}".format(i) for i in range(5)]
+    ul = Ul.from_rows(rows, attrs={"style": "color: red"}, escape=False,
+                      id="TheList")
+    expected = Ul(id="TheList")
+    for row in rows:
+        expected.append(Li(row, style="color: red"))
+    assert render_result(ul) == render_result(expected)
+    assert render_result(Html(ul), "  ") == render_result(Html(expected), "  ")
+    assert render_result(Ul.from_rows([])) == render_result(Ul())
+
+
+def test_from_rows_escapes():
+    """row text and attribute values are HTML-escaped"""
+    ul = Ul.from_rows(["a < b & c", "<script>", "x\x00y"],
+                      attrs={"title": 'say "hi"'})
+    file_contents = render_result(ul)
+    print(file_contents)
+    assert "a &lt; b &amp; c" in file_contents
+    assert "&lt;script&gt;" in file_contents
+    assert "<script>" not in file_contents
+    assert "x\x00y" in file_contents
+    assert 'title="say &quot;hi&quot;"' in file_contents
+    assert file_contents.count("<li ") == 3
+
+
+# deep trees
+
+def test_render_deeper_than_recursion_limit():
+    """nesting depth is not limited by the recursion limit"""
+    depth = sys.getrecursionlimit() * 2
+    top = node = P()
+    for _ in range(depth - 1):
+        child = P()
+        node.append(child)
+        node = child
+    node.append(Li("leaf"))
+    file_contents = render_result(top)
+    lines = file_contents.splitlines()
+    assert len(lines) == 2 * depth + 1
+    assert lines[depth] == "    " * depth + "<li >leaf</li>"
+    assert lines[-1] == "</p>"
+    assert file_contents == "".join(top.iter_render())
+
+
+def test_deep_memoized_subtree():
+    """memoized elements inside a deep tree are cached and reused"""
+    leaf = Ul(Li("leaf")).memoize()
+    top = node = Body()
+    for _ in range(sys.getrecursionlimit() + 10):
+        child = P()
+        node.append(child)
+        node = child
+    node.append(leaf)
+    reset_render_cache_stats()
+    first = render_result(top)
+    assert render_cache_stats()["misses"] == 1
+    assert render_result(top) == first
+    assert render_cache_stats()["hits"] == 1